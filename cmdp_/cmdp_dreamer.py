@@ -40,7 +40,7 @@ class Dreamer(nn.Module):
     self._should_expl = tools.Until( 
       int(config.expl_until / config.action_repeat)
     )
-    self._metrics = {}
+    self._metrics = tools.Metrics()
     self._step = count_steps(config.traindir)
     # Schedules.
     config.actor_entropy = (
@@ -84,9 +84,8 @@ class Dreamer(nn.Module):
         self._train(next(self._dataset))
 
       if self._should_log(step):
-        for name, values in self._metrics.items():
-          self._logger.scalar(name, float(np.mean(values)))
-          self._metrics[name] = []
+        for name, value in self._metrics.result().items():
+          self._logger.scalar(name, value)
         # openl = self._wm.video_pred(next(self._dataset))
         # self._logger.video('train_openl', to_np(openl))
         self._logger.write(fps=True)
@@ -163,11 +162,7 @@ class Dreamer(nn.Module):
       mets = self._expl_behavior.train(start, context, data)[-1]
       metrics.update({'expl_' + key: value for key, value in mets.items()})
     #update training metrics for logs
-    for name, value in metrics.items():
-      if not name in self._metrics.keys():
-        self._metrics[name] = [value]
-      else:
-        self._metrics[name].append(value)
+    self._metrics.update(metrics)
 
 
 def count_steps(folder):
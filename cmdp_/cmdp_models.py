@@ -6,7 +6,8 @@ import torch.optim as optim
 
 import cmdp_.networks as networks
 import cmdp_tools as tools
-to_np = lambda x: x.detach().cpu().numpy()
+# metrics stay on the device, Dreamer syncs them when it logs
+detach = lambda x: x.detach()
 
 
 class WorldModel(nn.Module):
@@ -15,7 +16,8 @@ class WorldModel(nn.Module):
     super(WorldModel, self).__init__()
     self._step = step
     self._cost_limit = config.cost_limit
-    self._use_amp = True if config.precision==16 else False
+    self._precision = tools.Precision(
+        config.precision, config.device, config.amp_dtype)
     self._config = config
     self.encoder = networks.ConvEncoder(config.grayscale,
         config.cnn_depth, config.act, config.encoder_kernels)
@@ -66,7 +68,7 @@ class WorldModel(nn.Module):
     self._model_opt = tools.Optimizer(
         'model', self.parameters(), config.model_lr, config.opt_eps, config.grad_clip,
         config.weight_decay, opt = config.opt,
-        use_amp = self._use_amp)
+        precision = self._precision)
     
     
     #MOD
@@ -77,7 +79,7 @@ class WorldModel(nn.Module):
     data = self.preprocess(data)
 
     with tools.RequiresGrad(self):
-      with torch.cuda.amp.autocast(self._use_amp):
+      with self._precision.autocast():
         embed = self.encoder(data)
         post, prior = self.dynamics.observe(embed, data['action'])
         kl_balance = tools.schedule(self._config.kl_balance, self._step)
@@ -108,17 +110,17 @@ class WorldModel(nn.Module):
         #lagrangian_loss = 
       metrics = self._model_opt(model_loss, self.parameters())
 
-    metrics.update({f'{name}_loss': to_np(loss) for name, loss in losses.items()})
+    metrics.update({f'{name}_loss': detach(loss) for name, loss in losses.items()})
     metrics['kl_balance'] = kl_balance
     metrics['kl_free'] = kl_free
     metrics['kl_scale'] = kl_scale
     metrics['cost_limit'] = self._cost_limit
-    metrics['kl'] = to_np(torch.mean(kl_value))
+    metrics['kl'] = detach(torch.mean(kl_value))
     # if self._config.learnable_lagrange:
-    #   metrics['lagrangian_multiplier'] = to_np(self._lagrangian_multiplier)
-    with torch.cuda.amp.autocast(self._use_amp):
-      metrics['prior_ent'] = to_np(torch.mean(self.dynamics.get_dist(prior).entropy()))
-      metrics['post_ent'] = to_np(torch.mean(self.dynamics.get_dist(post).entropy()))
+    #   metrics['lagrangian_multiplier'] = detach(self._lagrangian_multiplier)
+    with self._precision.autocast():
+      metrics['prior_ent'] = detach(torch.mean(self.dynamics.get_dist(prior).entropy()))
+      metrics['post_ent'] = detach(torch.mean(self.dynamics.get_dist(post).entropy()))
       context = dict(
           embed = embed, feat = self.dynamics.get_feat(post),
           kl = kl_value, postent = self.dynamics.get_dist(post).entropy())
@@ -194,7 +196,8 @@ class ImagBehavior(nn.Module):
 
   def __init__(self, config, world_model, stop_grad_actor=True, reward=None, cost = None):
     super(ImagBehavior, self).__init__()
-    self._use_amp = True if config.precision==16 else False
+    self._precision = tools.Precision(
+        config.precision, config.device, config.amp_dtype)
     self._config = config
     self._world_model = world_model
     self._stop_grad_actor = stop_grad_actor
@@ -236,7 +239,7 @@ class ImagBehavior(nn.Module):
             [], config.value_layers, config.units, config.act)
       self._updates = 0
 
-    kw = dict(wd = config.weight_decay, opt = config.opt, use_amp=self._use_amp) #?
+    kw = dict(wd = config.weight_decay, opt = config.opt, precision=self._precision) #?
     self._actor_opt = tools.Optimizer(
         'actor', self.actor.parameters(), config.actor_lr, config.opt_eps, config.actor_grad_clip,
         **kw)
@@ -283,7 +286,7 @@ class ImagBehavior(nn.Module):
     metrics = {}
 
     with tools.RequiresGrad(self.actor):
-      with torch.cuda.amp.autocast(self._use_amp): #prcesion
+      with self._precision.autocast(): #prcesion
         #imagination roll out
         imag_feat, imag_state, imag_action = self._imagine(
             start, self.actor, self._config.imag_horizon, repeats)
@@ -324,7 +327,7 @@ class ImagBehavior(nn.Module):
 
 
     with tools.RequiresGrad(self.value):
-      with torch.cuda.amp.autocast(self._use_amp):
+      with self._precision.autocast():
         value = self.value(value_input[:-1].detach())
         target = torch.stack(target, dim=1)
         value_loss = -value.log_prob(target.detach())
@@ -335,25 +338,25 @@ class ImagBehavior(nn.Module):
     #MOD
     if self._config.solve_cmdp:
       with tools.RequiresGrad(self.cost_value):
-        with torch.cuda.amp.autocast(self._use_amp):
+        with self._precision.autocast():
           cost_value = self.cost_value(value_input[:-1].detach())
           target_cost = torch.stack(target_cost, dim=1)
           cost_value_loss = -cost_value.log_prob(target_cost.detach())
           # multi[ly by weights only if we wish to dsicount the value function
           cost_value_loss = torch.mean(weights[:-1] * cost_value_loss[:,:,None])
 
-    metrics['reward_mean'] = to_np(torch.mean(reward))
-    metrics['reward_std'] = to_np(torch.std(reward))
+    metrics['reward_mean'] = detach(torch.mean(reward))
+    metrics['reward_std'] = detach(torch.std(reward))
 
     #MOD
-    metrics['cost_mean'] = to_np(torch.mean(cost))
-    metrics['cost_std'] = to_np(torch.std(cost))
+    metrics['cost_mean'] = detach(torch.mean(cost))
+    metrics['cost_std'] = detach(torch.std(cost))
 
 
-    metrics['actor_ent'] = to_np(torch.mean(actor_ent))
-    metrics['mean_target'] = to_np(torch.mean(target.detach()))
-    metrics['max_target'] = to_np(torch.max(target.detach()))
-    metrics['std_target'] = to_np(torch.std(target.detach()))
+    metrics['actor_ent'] = detach(torch.mean(actor_ent))
+    metrics['mean_target'] = detach(torch.mean(target.detach()))
+    metrics['max_target'] = detach(torch.max(target.detach()))
+    metrics['std_target'] = detach(torch.std(target.detach()))
 
     with tools.RequiresGrad(self):
       metrics.update(self._actor_opt(actor_loss, self.actor.parameters()))
@@ -365,14 +368,14 @@ class ImagBehavior(nn.Module):
 
     #MOD
     if self._config.solve_cmdp:
-      metrics['mean_target_cost'] = to_np(torch.mean(target_cost.detach()))
-      metrics['max_target_cost'] = to_np(torch.max(target_cost.detach()))
-      metrics['std_target_cost'] = to_np(torch.std(target_cost.detach()))
-      metrics['min_target_cost'] = to_np(torch.min(target_cost.detach()))
+      metrics['mean_target_cost'] = detach(torch.mean(target_cost.detach()))
+      metrics['max_target_cost'] = detach(torch.max(target_cost.detach()))
+      metrics['std_target_cost'] = detach(torch.std(target_cost.detach()))
+      metrics['min_target_cost'] = detach(torch.min(target_cost.detach()))
 
     #log lagranian multipler
     if self._config.solve_cmdp and self._config.learnable_lagrange :
-      metrics['lagrangian_multiplier'] = self._lagrangian_multiplier.item() if self._config.learnable_lagrange else self._lagrangian_multiplier
+      metrics['lagrangian_multiplier'] = self._lagrangian_multiplier.detach() if self._config.learnable_lagrange else self._lagrangian_multiplier
 
     #update lagrane multiplier if needed
     if self._config.solve_cmdp and self._config.learnable_lagrange:
@@ -520,11 +520,39 @@ def lambda_return_cost(
 
 
 
+class Precision:
+  '''
+  Mixed precision for the device the model trains on. With precision 16
+  autocast() runs in `dtype` on that device: 'auto' picks bfloat16 on CPU,
+  where float16 autocast is not supported, and float16 on CUDA. Only float16
+  on CUDA needs loss scaling, every other setting gets a disabled GradScaler
+  that passes the loss and the step straight through.
+  '''
+
+  def __init__(self, precision, device, dtype='auto'):
+    self.device_type = torch.device(device).type
+    if dtype == 'auto':
+      dtype = 'float16' if self.device_type == 'cuda' else 'bfloat16'
+    self.dtype = getattr(torch, dtype)
+    self.enabled = precision == 16
+    if self.enabled and self.device_type == 'cuda' and self.dtype == torch.bfloat16:
+      assert torch.cuda.is_bf16_supported(), 'bfloat16 is not supported by this gpu'
+    if self.enabled and self.device_type == 'cpu':
+      assert self.dtype == torch.bfloat16, 'autocast on cpu needs bfloat16'
+    self.scaled = self.enabled and self.device_type == 'cuda' and self.dtype == torch.float16
+
+  def autocast(self):
+    return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+  def scaler(self):
+    return torch.cuda.amp.GradScaler(enabled=self.scaled)
+
+
 class Optimizer():
 
   def __init__(
       self, name, parameters, lr, eps=1e-4, clip=None, wd=None, wd_pattern=r'.*',
-      opt='adam', use_amp=False):
+      opt='adam', use_amp=False, precision=None):
     assert 0 <= wd < 1
     assert not clip or 1 <= clip
     self._name = name
@@ -547,12 +575,15 @@ class Optimizer():
                                 lr=lr,
                                 momentum=0.9),
     }[opt]()
-    self._scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+    # a Precision decides the scaler, use_amp alone means float16 on cuda
+    self._scaler = precision.scaler() if precision else \
+        torch.cuda.amp.GradScaler(enabled=use_amp)
 
   def __call__(self, loss, params, retain_graph=False):
     assert len(loss.shape) == 0, loss.shape
     metrics = {}
-    metrics[f'{self._name}_loss'] = loss.detach().cpu().numpy()
+    # stays on the device until Metrics reduces it at the log interval
+    metrics[f'{self._name}_loss'] = loss.detach()
     self._scaler.scale(loss).backward()
     self._scaler.unscale_(self._opt)
     #loss.backward(retain_graph=retain_graph)
@@ -563,7 +594,7 @@ class Optimizer():
     self._scaler.update()
     #self._opt.step()
     self._opt.zero_grad()
-    metrics[f'{self._name}_grad_norm'] = norm.item()
+    metrics[f'{self._name}_grad_norm'] = norm.detach()
     return metrics
 
   def _apply_weight_decay(self, varibs):
@@ -658,6 +689,64 @@ def static_scan(fn, inputs, start):
 #  return res
 
 
+class Metrics:
+  '''
+  Accumulates training metrics per name without leaving the device: a
+  running sum, sum of squares, min and max as tensors and the count on
+  the host. result() moves all names to the host with one copy per
+  device and reduces them with any of mean, std, min and max.
+  '''
+
+  def __init__(self, reductions=('mean',)):
+    assert all(r in ('mean', 'std', 'min', 'max') for r in reductions), reductions
+    self._reductions = tuple(reductions)
+    self._stats = {}
+    self._counts = {}
+
+  def add(self, name, value):
+    if not torch.is_tensor(value):
+      value = torch.as_tensor(np.asarray(value, dtype=np.float32))
+    value = value.detach().float().reshape(-1)
+    stats = torch.stack([
+        value.sum(), (value * value).sum(), value.min(), value.max()])
+    if name in self._stats:
+      old = self._stats[name]
+      stats = torch.stack([
+          old[0] + stats[0], old[1] + stats[1],
+          torch.minimum(old[2], stats[2]), torch.maximum(old[3], stats[3])])
+    self._stats[name] = stats
+    self._counts[name] = self._counts.get(name, 0) + value.numel()
+
+  def update(self, metrics):
+    for name, value in metrics.items():
+      self.add(name, value)
+
+  def result(self, reset=True):
+    devices = {}
+    for name, stats in self._stats.items():
+      devices.setdefault(stats.device, []).append(name)
+    result = {}
+    for names in devices.values():
+      # the single sync for all names on this device
+      stats = torch.stack([self._stats[name] for name in names]).cpu().numpy()
+      for name, (total, squares, low, high) in zip(names, stats):
+        count = self._counts[name]
+        mean = total / count
+        values = dict(
+            mean=mean, std=np.sqrt(max(squares / count - mean ** 2, 0.0)),
+            min=low, max=high)
+        for reduction in self._reductions:
+          key = name if reduction == 'mean' else f'{name}_{reduction}'
+          result[key] = float(values[reduction])
+    if reset:
+      self.reset()
+    return result
+
+  def reset(self):
+    self._stats = {}
+    self._counts = {}
+
+
 class Every:
 
   def __init__(self, every):
@@ -13,7 +13,8 @@ class WorldModel(nn.Module):
   def __init__(self, step, config):
     super(WorldModel, self).__init__()
     self._step = step
-    self._use_amp = True if config.precision==16 else False
+    self._precision = tools.Precision(
+        config.precision, config.device, config.amp_dtype)
     self._config = config
     self.encoder = networks.ConvEncoder(config.grayscale,
         config.cnn_depth, config.act, config.encoder_kernels)
@@ -54,7 +55,7 @@ class WorldModel(nn.Module):
     self._model_opt = tools.Optimizer(
         'model', self.parameters(), config.model_lr, config.opt_eps, config.grad_clip,
         config.weight_decay, opt = config.opt,
-        use_amp = self._use_amp)
+        precision = self._precision)
     self._scales = dict(
         reward = config.reward_scale, discount = config.discount_scale)
 
@@ -62,7 +63,7 @@ class WorldModel(nn.Module):
     data = self.preprocess(data)
 
     with tools.RequiresGrad(self):
-      with torch.cuda.amp.autocast(self._use_amp):
+      with self._precision.autocast():
         embed = self.encoder(data)
         post, prior = self.dynamics.observe(embed, data['action'])
         kl_balance = tools.schedule(self._config.kl_balance, self._step)
@@ -88,7 +89,7 @@ class WorldModel(nn.Module):
     metrics['kl_free'] = kl_free
     metrics['kl_scale'] = kl_scale
     metrics['kl'] = to_np(torch.mean(kl_value))
-    with torch.cuda.amp.autocast(self._use_amp):
+    with self._precision.autocast():
       metrics['prior_ent'] = to_np(torch.mean(self.dynamics.get_dist(prior).entropy()))
       metrics['post_ent'] = to_np(torch.mean(self.dynamics.get_dist(post).entropy()))
       context = dict(
@@ -138,7 +139,8 @@ class ImagBehavior(nn.Module):
 
   def __init__(self, config, world_model, stop_grad_actor=True, reward=None):
     super(ImagBehavior, self).__init__()
-    self._use_amp = True if config.precision==16 else False
+    self._precision = tools.Precision(
+        config.precision, config.device, config.amp_dtype)
     self._config = config
     self._world_model = world_model
     self._stop_grad_actor = stop_grad_actor
@@ -164,7 +166,7 @@ class ImagBehavior(nn.Module):
           feat_size,  # pytorch version
           [], config.value_layers, config.units, config.act)
       self._updates = 0
-    kw = dict(wd=config.weight_decay, opt=config.opt, use_amp=self._use_amp) #?
+    kw = dict(wd=config.weight_decay, opt=config.opt, precision=self._precision) #?
     self._actor_opt = tools.Optimizer(
         'actor', self.actor.parameters(), config.actor_lr, config.opt_eps, config.actor_grad_clip,
         **kw)
@@ -180,7 +182,7 @@ class ImagBehavior(nn.Module):
     metrics = {}
 
     with tools.RequiresGrad(self.actor):
-      with torch.cuda.amp.autocast(self._use_amp): #prcesion
+      with self._precision.autocast(): #prcesion
         imag_feat, imag_state, imag_action = self._imagine(
             start, self.actor, self._config.imag_horizon, repeats)
         
@@ -202,7 +204,7 @@ class ImagBehavior(nn.Module):
         value_input = imag_feat # inputs to value network
 
     with tools.RequiresGrad(self.value):
-      with torch.cuda.amp.autocast(self._use_amp):
+      with self._precision.autocast():
         value = self.value(value_input[:-1].detach())
         target = torch.stack(target, dim=1)
         value_loss = -value.log_prob(target.detach())
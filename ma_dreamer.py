@@ -1,9 +1,12 @@
 import argparse
 import collections
+import copy
 import functools
 import os
 import pathlib
+import queue
 import sys
+import time
 import warnings
 import wandb
 if sys.platform == 'linux':
@@ -29,10 +32,14 @@ to_np = lambda x: x.detach().cpu().numpy()
 # online_mean_cost_calc = tools.OnlineMeanCalculator()
 online_mean_cost_calc = tools.RollingMeanCalculator(50)
 VideoInteractionSaver = tools.SaveVideoInteraction()
+# set in main when episodes are written in the background
+episode_writer = None
+# set in main when the newest episodes are also kept on the device
+recent_replay = None
 
 class Dreamer(nn.Module):
 
-  def __init__(self, config, logger, dataset):
+  def __init__(self, config, logger, dataset, recent = None):
     super(Dreamer, self).__init__()
     self._config = config
     self._logger = logger
@@ -43,9 +50,10 @@ class Dreamer(nn.Module):
     self._should_expl = tools.Until( 
       int(config.expl_until / config.action_repeat)
     )
-    self._metrics = {}
+    self._metrics = tools.Metrics(config.log_reductions)
     self._step = count_steps(config.traindir)
-    self.count_before_switch = 0
+    # per env steps left on the safe policy, a device tensor sized on first use
+    self.count_before_switch = None
     # Schedules.
     config.actor_entropy = (
         lambda x = config.actor_entropy: tools.schedule(x, self._step))
@@ -58,8 +66,15 @@ class Dreamer(nn.Module):
     config.imag_gradient_mix = (
         lambda x=config.imag_gradient_mix: tools.schedule(x, self._step))
     
-    self._dataset = dataset
+    tools.compile_lambda_returns(config.lambda_compile)
     self._wm = models.WorldModel(self._step, config)
+    # actors of the decoupled mode only collect and get no dataset
+    self._dataset = tools.Prefetcher(
+        dataset, self._wm.normalize, config.device, config.prefetch) \
+        if dataset is not None else None
+    if recent is not None and self._dataset is not None:
+      self._dataset = tools.MixedReplay(
+          recent, self._dataset, self._wm.normalize, config.recent_ratio)
     self._task_behavior = models.ImagBehavior(
         config, self._wm, config.behavior_stop_grad)
     #inline function to get the reward prediction using world model, not sure why we need it though
@@ -69,21 +84,19 @@ class Dreamer(nn.Module):
         random = lambda: expl.Random(config),
         plan2explore = lambda: expl.Plan2Explore(config, self._wm, reward),
     )[config.expl_behavior]()
-    self.number_of_switches = 0
+    # switches to the safe policy per env, a device tensor sized on first use
+    self.number_of_switches = None
 
   def __call__(self, obs, reset, state = None, reward = None, cost = None, training = True):
     step = self._step
     if self._should_reset(step):
       state = None
     if state is not None and reset.any():
-      self.count_before_switch = 0
-      self.number_of_switches = 0
-      mask = 1 - reset
-      for key in state[0].keys():
-        for i in range(state[0][key].shape[0]):
-          state[0][key][i] *= mask[i]
-      for i in range(len(state[1])):
-        state[1][i] *= mask[i]
+      # only the envs that reset start their switching state over
+      for counter in (self.count_before_switch, self.number_of_switches):
+        if counter is not None and len(counter) == len(reset):
+          counter[torch.as_tensor(reset, device=counter.device)] = 0
+      mask_state(state, reset)
     if training and self._should_train(step):
       steps = (
           self._config.pretrain if self._should_pretrain()
@@ -93,12 +106,7 @@ class Dreamer(nn.Module):
         self._train(next(self._dataset))
 
       if self._should_log(step):
-        for name, values in self._metrics.items():
-          self._logger.scalar(name, float(np.mean(values)))
-          self._metrics[name] = []
-        # openl = self._wm.video_pred(next(self._dataset))
-        # self._logger.video('train_openl', to_np(openl))
-        self._logger.write(fps=True)
+        self._write_metrics()
 
     policy_output, state = self._policy(obs, state, training)
 
@@ -107,70 +115,111 @@ class Dreamer(nn.Module):
       self._logger.step = self._config.action_repeat * self._step
     return policy_output, state
 
-  def _is_future_safety_violated(self, posterior_t, is_eval = False):
+  def _write_metrics(self):
+    # device tensors are synced here, once per log interval
+    for name, value in self._metrics.result().items():
+      self._logger.scalar(name, value)
+    # openl = self._wm.video_pred(next(self._dataset))
+    # self._logger.video('train_openl', to_np(openl))
+    self._logger.write(fps=True)
+
+  def policy_modules(self):
+    '''
+    Modules an actor process needs to act, kept in sync by the learner.
+    '''
+    return {
+        'wm': self._wm, 'actor': self._task_behavior.actor,
+        'safe_actor': self._task_behavior.safe_actor}
+
+  def _is_future_safety_violated(self, posterior_t, is_eval = False, active = None):
     '''
     Starting from current state we roll out using learned model
-    to forcast constraint violation under control policy
+    to forcast constraint violation under control policy.
+    All envs are rolled out together and the cost is summed on device,
+    returns a bool mask with one entry per env. Envs outside the `active`
+    mask keep their counters and are reported as not violating.
     '''
-    if self.count_before_switch > 0:
-      self.count_before_switch -= 1
-      # we only return to possibility to use control policy after number of steps to reach saftey has passed
-      return True
-
-    total_cost = 0
-    cost_fn = lambda f, s, a: self._wm.heads['cost'](f).mode()
-        # self._wm.dynamics.get_feat(s)  ).mode()
+    batch_size = posterior_t['deter'].shape[0]
+    count = self.count_before_switch
+    if count is None or len(count) != batch_size:
+      count = torch.zeros(batch_size, dtype=torch.long, device=posterior_t['deter'].device)
+    if active is None:
+      active = torch.ones(batch_size, dtype=torch.bool, device=count.device)
+    # we only return to possibility to use control policy after number of steps to reach saftey has passed
+    pending = active & (count > 0)
+
+    total_cost = torch.zeros(batch_size, device=posterior_t['deter'].device)
     with torch.no_grad():
         latent_state = posterior_t
         for _ in range(self._config.safety_look_ahead_steps):
             feat = self._wm.dynamics.get_feat(latent_state)
-            c_t = cost_fn(feat,_,_).item()
-            total_cost += c_t
+            total_cost += self._wm.heads['cost'](feat).mode().reshape(batch_size)
             actor = self._task_behavior.actor(feat)
             action = actor.sample() if not is_eval  else actor.mode()
             latent_state = self._wm.dynamics.img_step(latent_state, action, sample = self._config.imag_sample)
-    #return total_cost >= self._config.cost_threshold
-
-    is_violation = total_cost >= self._config.cost_threshold
-
-    if is_violation: 
-      self.count_before_switch = self._config.num_safety_steps
-      self.count_before_switch -= 1 # we are using one safety task so we reduce it
-      return True
-    return False
-
-  def get_safe_action(self, latent):
-    if self._config.sample_safe_action:
-      population = [] # (first_action, cost sum, value[t+H])
-      cost_fn = lambda f, s, a: self._wm.heads['cost'](f).mode()
-      number_candidate = 0 # number of agents that dont violate at all
-      for n in range(self._config.num_sampled_action):
-        total_cost = 0
-        for h in range(self._config.safety_look_ahead_steps):
-            feat = self._wm.dynamics.get_feat(latent)
-            c_t = cost_fn(feat, None , None).item()
-            total_cost += c_t
-            action = self._task_behavior.safe_actor(feat).sample()
-            if h == 0: # first state
-              first_action = action
-            latent_state = self._wm.dynamics.img_step(latent_state, action, sample = self._config.imag_sample)
-            if h == self._config.safety_look_ahead_steps - 1: # last time step
-              #get the value
-              value = self._task_behavior.value(feat)
-              if total_cost <= 2:
-                number_candidate += 1
-              population.append(first_action, value, total_cost)
-
-      population.sort(key= lambda x : x[2])
-      if number_candidate >= self._config.N: # we have enough candidate agents so we just pick action with best value
-        candidates = population[:number_candidate]
-        candidates.sort(candidates, key=[1])
-        return candidates[0]
-      else: # we couldnt find enough candidate action so we select safest action
-        return population[0][0]
-    else:
-      feat = self._wm.dynamics.get_feat(latent)
-      self._task_behavior.safe_actor(feat).sample()
+
+    is_violation = active & ~pending & (total_cost >= self._config.cost_threshold)
+    # we are using one safety task so we reduce it
+    count = torch.where(pending, count - 1, count)
+    count = torch.where(is_violation, torch.full_like(count, self._config.num_safety_steps - 1), count)
+    self.count_before_switch = count
+    return pending | is_violation
+
+  def get_safe_action(self, latent, is_eval = False):
+    '''
+    Model predictive choice of the safe action. The latent of every env is
+    tiled into num_sampled_action candidates whose first action comes from
+    the safe actor, all candidates are rolled out together and scored by
+    predicted cost over the look-ahead and the value at its end:
+    - candidates under cost_threshold are ranked by value
+    - if an env has none, its least costly candidate is taken
+    With safe_action_cem_iters > 0 the first actions are refit to the
+    elites and resampled before the final choice.
+    '''
+    num = self._config.num_sampled_action
+    batch_size = latent['deter'].shape[0]
+    with torch.no_grad():
+      start = {k: v.repeat(num, *[1] * (v.dim() - 1)) for k, v in latent.items()}
+      actor = self._task_behavior.safe_actor(self._wm.dynamics.get_feat(start))
+      first = actor.sample()
+      for iteration in range(self._config.safe_action_cem_iters + 1):
+        score = self._score_safe_actions(start, first, is_eval)
+        score = score.reshape(num, batch_size)
+        first = first.reshape(num, batch_size, -1)
+        if iteration == self._config.safe_action_cem_iters:
+          break
+        elites = score.topk(min(self._config.safe_action_elites, num), 0).indices
+        elites = first.gather(0, elites[..., None].expand(-1, -1, first.shape[-1]))
+        if 'onehot' in self._config.actor_dist:
+          sample = tools.OneHotDist(probs=elites.mean(0)).sample([num])
+        else:
+          mean, std = elites.mean(0), elites.std(0, unbiased=False)
+          sample = torch.clip(mean + std * torch.randn_like(first), -1, 1)
+        first = sample.reshape(num * batch_size, -1)
+      best = score.argmax(0)
+      return first[best, torch.arange(batch_size, device=best.device)]
+
+  def _score_safe_actions(self, start, first, is_eval = False):
+    '''
+    Rolls the candidates out under the safe actor after their first action,
+    the score ranks safe candidates above all others, one column per env.
+    '''
+    dynamics = self._wm.dynamics
+    latent_state, action = start, first
+    total_cost = torch.zeros(first.shape[0], device=first.device)
+    for h in range(self._config.safety_look_ahead_steps):
+      feat = dynamics.get_feat(latent_state)
+      total_cost += self._wm.heads['cost'](feat).mode().reshape(-1)
+      if h > 0:
+        actor = self._task_behavior.safe_actor(feat)
+        action = actor.mode() if is_eval else actor.sample()
+      latent_state = dynamics.img_step(latent_state, action, sample = self._config.imag_sample)
+    value = self._task_behavior.value(dynamics.get_feat(latent_state)).mode().reshape(-1)
+    num = self._config.num_sampled_action
+    total_cost, value = total_cost.reshape(num, -1), value.reshape(num, -1)
+    safe = total_cost <= self._config.cost_threshold
+    score = torch.where(safe, value, torch.full_like(value, -float('inf')))
+    return torch.where(safe.any(0, keepdim=True), score, -total_cost).reshape(-1)
 
   def _task_switch_prob(self):
     '''
@@ -205,54 +254,53 @@ class Dreamer(nn.Module):
       latent['stoch'] = latent['mean']
     feat = self._wm.dynamics.get_feat(latent)
     
-    if not self._config.solve_cmdp:
-      constraint_violated = False
-      
-    elif self.number_of_switches > self._config.switch_budget:
-      if not training: #ignore cap
-        constraint_violated = self._is_future_safety_violated(latent)
-      else:
-        constraint_violated = False
-
-    elif np.random.uniform(0, 1) < self._task_switch_prob():
-      constraint_violated = False
-
-    else:
-      constraint_violated = self._is_future_safety_violated(latent)
-    # constraint_violated = False if np.random.uniform(0, 1) < self._task_switch_prob() \
-    #                               else self._is_future_safety_violated(latent)
+    batch_size = feat.shape[0]
+    device = feat.device
+    if self.number_of_switches is None or len(self.number_of_switches) != batch_size:
+      self.number_of_switches = torch.zeros(batch_size, dtype=torch.long, device=device)
+    # per env choice of the safe policy, made without leaving the device
+    constraint_violated = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    if self._config.solve_cmdp:
+      # envs that use the control policy without looking ahead this step
+      explore = np.random.uniform(0, 1, batch_size) < self._task_switch_prob()
+      # the look-ahead is skipped when no env can use it
+      if not (training and explore.all()):
+        active = ~torch.as_tensor(explore, device=device)
+        over_budget = self.number_of_switches > self._config.switch_budget
+        if training:
+          active &= ~over_budget
+        else: #ignore cap
+          active |= over_budget
+        constraint_violated = self._is_future_safety_violated(latent, active = active)
     if self._config.only_safe_policy:
-      constraint_violated = True
-    self.number_of_switches += 1 if constraint_violated else 0
-
+      constraint_violated = torch.ones_like(constraint_violated)
+    self.number_of_switches += constraint_violated.long()
+
+    # both actors run on the whole batch and each env takes its own
+    behavior = self._task_behavior
+    if training and self._should_expl(self._step):
+      behavior = self._expl_behavior
+    # Random and Plan2Explore have no safe actor of their own
+    safe_actor = getattr(behavior, 'safe_actor', self._task_behavior.safe_actor)
+    actor, safe_actor = behavior.actor(feat), safe_actor(feat)
     if not training:
       #in this case no need for epsilon greedy
-      actor =  self._task_behavior.safe_actor(feat) if constraint_violated \
-              else self._task_behavior.actor(feat)
-      action = actor.mode()
-
-    elif self._should_expl(self._step):
-      actor =  self._expl_behavior.safe_actor(feat) if constraint_violated \
-              else self._expl_behavior.actor(feat)
-      action = actor.sample()
-
-      # actor =  self._expl_behavior.safe_actor(feat) if constraint_violated \
-      #         else self._expl_behavior.actor(feat)
-      
-      # action = self.get_safe_action if constraint_violated else actor.sample()
+      action, safe_action = actor.mode(), safe_actor.mode()
     else:
-      actor =  self._task_behavior.safe_actor(feat) if constraint_violated \
-              else self._task_behavior.actor(feat)
-      action = actor.sample()
+      action, safe_action = actor.sample(), safe_actor.sample()
+    if self._config.sample_safe_action and constraint_violated.any():
+      safe_action = self.get_safe_action(latent, not training)
+    switched = constraint_violated[:, None]
+    action = torch.where(switched, safe_action, action)
+    logprob = torch.where(
+        constraint_violated, safe_actor.log_prob(action), actor.log_prob(action))
 
-    logprob = actor.log_prob(action)
     latent = {k: v.detach()  for k, v in latent.items()}
     action = action.detach()
     if self._config.actor_dist == 'onehot_gumble':
       action = torch.one_hot(torch.argmax(action, dim=-1), self._config.num_actions)
     action = self._exploration(action, training)
-    num_task_switch = 1 if constraint_violated else 0
-    policy_output = {'action': action, 'logprob': logprob, 'task_switch' : torch.tensor([num_task_switch])}
+    policy_output = {'action': action, 'logprob': logprob, 'task_switch' : constraint_violated.long()}
     state = (latent, action)
     return policy_output, state
 
@@ -268,7 +316,7 @@ class Dreamer(nn.Module):
     raise NotImplementedError(self._config.action_noise)
 
   def _train(self, data):
-    metrics = {}
+    metrics = self._dataset.metrics()
     # train world model
     post, context, mets = self._wm._train(data)
     metrics.update(mets)
@@ -277,10 +325,9 @@ class Dreamer(nn.Module):
       start = {k: v[:, :-1] for k, v in post.items()}
       context = {k: v[:, :-1] for k, v in context.items()}
 
-    reward = lambda f, s, a: self._wm.heads['reward'](
-        self._wm.dynamics.get_feat(s)).mode()
-    cost = lambda f, s, a: self._wm.heads['cost'](
-        self._wm.dynamics.get_feat(s)).mode()
+    # f is already the feature of s, the imagination computed it
+    reward = lambda f, s, a: self._wm.heads['reward'](f).mode()
+    cost = lambda f, s, a: self._wm.heads['cost'](f).mode()
     metrics.update(self._task_behavior._train(start, reward, cost, mean_ep_cost = online_mean_cost_calc.get_mean(), training_step = self._logger.step )[-1])
 
     if self._config.expl_behavior != 'greedy':
@@ -288,12 +335,11 @@ class Dreamer(nn.Module):
         data = {k: v[:, :-1] for k, v in data.items()}
       mets = self._expl_behavior.train(start, context, data)[-1]
       metrics.update({'expl_' + key: value for key, value in mets.items()})
+    if self._config.fused_scalar_heads:
+      # the memoized head outputs hold the imagination graph otherwise
+      self._wm.scalar_heads.clear()
     #update training metrics for logs
-    for name, value in metrics.items():
-      if not name in self._metrics.keys():
-        self._metrics[name] = [value]
-      else:
-        self._metrics[name].append(value)
+    self._metrics.update(metrics)
 
 
 def count_steps(folder):
@@ -302,17 +348,32 @@ def count_steps(folder):
   - COunt the file names wit that extension to know number of steps
 
   '''
+  manifest = tools.manifest(folder)
+  if manifest.exists:
+    return manifest.steps()
   return sum(int(str(n).split('-')[-1][:-4]) - 1 for n in folder.glob('*.npz'))
 
 
-def make_dataset(episodes, config):
-  generator = tools.sample_episodes(
-      episodes, config.batch_length, config.oversample_ends)
-  dataset = tools.from_generator(generator, config.batch_size)
+def make_dataset(episodes, config, directory = None):
+  # the prefetch queue, the batch being built and the one in use all hold a
+  # sampler buffer until they are copied
+  buffers = config.prefetch + 2
+  if directory:
+    # streams the episode files of the directory instead of the episodes
+    return tools.StreamingDataset(
+        directory, config.batch_size, config.batch_length,
+        config.stream_reservoir, config.stream_swap, config.oversample_ends,
+        config.seed, config.stream_workers, buffers)
+  dataset = tools.BatchSampler(
+      episodes, config.batch_size, config.batch_length, config.oversample_ends,
+      buffers = buffers)
   return dataset
 
 
-def make_env(config, logger, mode, train_eps, eval_eps):
+def make_base_env(config):
+  '''
+  Simulator part of the env stack, the part that can run in a subprocess.
+  '''
   if config.task_type == 'dmc':
     env = wrappers.DMGymnassium(config.task, config.grayscale, action_repeat = config.action_repeat )
   else:
@@ -322,8 +383,14 @@ def make_env(config, logger, mode, train_eps, eval_eps):
   env = wrappers.NormalizeActions(env)
   env = wrappers.TimeLimit(env, config.time_limit)
   env = wrappers.SelectAction(env, key='action')
+  return env
+
+
+def make_env(config, logger, mode, train_eps, eval_eps, env = None, callbacks = None):
+  # the dataset callbacks always run in this process
+  env = env or make_base_env(config)
   if (mode == 'train') or (mode == 'eval'):
-    callbacks = [functools.partial(
+    callbacks = callbacks or [functools.partial(
         process_episode, config, logger, mode, train_eps, eval_eps)]
     env = wrappers.CollectDataset(env, callbacks)
   env = wrappers.RewardObs(env)
@@ -334,7 +401,12 @@ def make_env(config, logger, mode, train_eps, eval_eps):
 def process_episode(config, logger, mode, train_eps, eval_eps, episode):
   directory = dict(train = config.traindir, eval = config.evaldir)[mode]
   cache = dict(train = train_eps, eval = eval_eps)[mode]
-  filename = tools.save_episodes(directory, [episode])[0]
+  if episode_writer:
+    filename = episode_writer.write(directory, episode)
+    for name, value in episode_writer.metrics().items():
+      logger.scalar(name, value)
+  else:
+    filename = tools.save_episodes(directory, [episode], config.episode_codec)[0]
   length = len(episode['reward']) - 1
   score = float(episode['reward'].astype(np.float64).sum())
   score_cost = float(episode['cost'].astype(np.float64).sum())
@@ -344,7 +416,30 @@ def process_episode(config, logger, mode, train_eps, eval_eps, episode):
   if mode == 'eval':
     VideoInteractionSaver.save_video(video, score, score_cost, episode['task_switch'])
     cache.clear()
-  if mode == 'train' and config.dataset_size:
+  if mode == 'train' and isinstance(cache, tools.ReplayStore):
+    # the ring buffer evicts the oldest episodes itself
+    cache[str(filename)] = episode
+    logger.scalar('dataset_size', cache.size)
+  elif mode == 'train' and config.dataset_size and not config.offline_traindir \
+      and tools.manifest(directory).exists:
+    # walk the manifest from the newest episode instead of sorting the cache
+    manifest = tools.manifest(directory)
+    # only the entries that are not evicted yet, entries[0] is manifest.evicted
+    entries = manifest.entries()
+    total, cutoff = 0, len(entries)
+    while cutoff > 0 and total <= config.dataset_size - length:
+      cutoff -= 1
+      if entries[cutoff]['filename'] != pathlib.Path(filename).name:
+        total += entries[cutoff]['length'] - 1
+    # the cache is keyed by expanded paths, like save_episodes writes them
+    folder = pathlib.Path(directory).expanduser()
+    # load_episodes may still be filling the cache in the background
+    with manifest.cache_lock:
+      for entry in entries[:cutoff]:
+        cache.pop(str(folder / entry['filename']), None)
+      manifest.evicted += cutoff
+    logger.scalar('dataset_size', total + length)
+  elif mode == 'train' and config.dataset_size:
     total = 0
     for key, ep in reversed(sorted(cache.items(), key=lambda x: x[0])):
       if total <= config.dataset_size - length:
@@ -352,7 +447,10 @@ def process_episode(config, logger, mode, train_eps, eval_eps, episode):
       else:
         del cache[key]
     logger.scalar('dataset_size', total + length)
-  cache[str(filename)] = episode
+  if not isinstance(cache, tools.ReplayStore):
+    cache[str(filename)] = episode
+  if mode == 'train' and recent_replay is not None:
+    recent_replay.add(episode)
   print(f'{mode.title()} episode has {length} steps, return {score:.1f}, cost {score_cost:.1f} and algorithm switched task {num_task_switch:.1f} times to safe agent.')
   if mode == 'train':
     online_mean_cost_calc.update(score_cost)
@@ -367,6 +465,160 @@ def process_episode(config, logger, mode, train_eps, eval_eps, episode):
   logger.write()
 
 
+def mask_state(state, reset):
+  '''
+  Zeros the latent and last action of the envs that reset, which is
+  RSSM.initial, with one broadcast multiply per tensor.
+  '''
+  latent, action = state
+  mask = torch.as_tensor(1 - reset, dtype=action.dtype, device=action.device)
+  for value in list(latent.values()) + [action]:
+    value *= mask.reshape([-1] + [1] * (value.dim() - 1)).to(value.dtype)
+  return state
+
+
+def policy_weights(agent):
+  return {
+      f'{name}/{key}': value
+      for name, module in agent.policy_modules().items()
+      for key, value in module.state_dict().items()}
+
+
+def run_actor(config, index, ratio, episodes, weights, lock, version, env_steps, updates, stop):
+  '''
+  Actor process of the decoupled mode. Collects with a copy of the policy
+  that is reloaded whenever the learner publishes new weights and sends
+  finished episodes to the learner.
+  '''
+  np.random.seed(config.seed + index)
+  torch.manual_seed(config.seed + index)
+  config.device = config.actor_device
+  config.train_every = 0 # never trains
+  logdir = pathlib.Path(config.logdir).expanduser()
+  logger = tools.Logger(logdir / f'actor{index}', 0)
+  envs = [
+      make_env(config, logger, 'train', None, None, callbacks = [episodes.put])
+      for _ in range(config.envs)]
+  agent = Dreamer(config, logger, None).to(config.device)
+  agent.requires_grad_(requires_grad = False)
+  modules = agent.policy_modules()
+  synced = 0
+  def policy(obs, reset, state = None, reward = None, cost = None):
+    nonlocal synced
+    # do not run further ahead of the learner than the slack allows
+    while (not stop.is_set() and
+           env_steps.value > updates.value / ratio + config.actor_slack):
+      time.sleep(0.01)
+    if version.value != synced:
+      with lock:
+        synced = version.value
+        for name, module in modules.items():
+          module.load_state_dict({
+              key.split('/', 1)[1]: value for key, value in weights.items()
+              if key.split('/', 1)[0] == name})
+    output = agent(obs, reset, state, reward, cost)
+    with env_steps.get_lock():
+      env_steps.value += len(reset)
+    return output
+  state = None
+  while not stop.is_set():
+    # returns after the first finished episode
+    state = tools.simulate(policy, envs, 1, state = state)
+  for env in envs:
+    try:
+      env.close()
+    except Exception:
+      pass
+
+
+def train_decoupled(config, actor_config, agent, logger, train_eps, eval_eps,
+                    eval_envs, eval_dataset, logdir):
+  '''
+  Learner of the decoupled mode. Trains continuously at learner_ratio
+  updates per env step while the actor processes collect.
+  '''
+  context = torch.multiprocessing.get_context('spawn')
+  weights = {
+      key: value.detach().cpu().clone().share_memory_()
+      for key, value in policy_weights(agent).items()}
+  lock = context.Lock()
+  version = context.Value('l', 1)
+  env_steps = context.Value('l', 0)
+  updates = context.Value('l', 0)
+  episodes = context.Queue()
+  stop = context.Event()
+  ratio = config.learner_ratio or config.train_steps / config.train_every
+  actors = [
+      context.Process(target = run_actor, daemon = True, args = (
+          actor_config, index, ratio, episodes, weights, lock, version,
+          env_steps, updates, stop))
+      for index in range(config.actors)]
+  for actor in actors:
+    actor.start()
+  start = agent._step
+  should_eval = tools.Every(config.eval_every)
+  if agent._should_pretrain():
+    for _ in range(config.pretrain):
+      agent._train(next(agent._dataset))
+  while agent._step < config.steps:
+    try:
+      # blocks briefly only when there is nothing to train on
+      wait = 0 if updates.value < ratio * env_steps.value else 0.1
+      episode = episodes.get(timeout = wait) if wait else episodes.get_nowait()
+      process_episode(config, logger, 'train', train_eps, eval_eps, episode)
+      continue
+    except queue.Empty:
+      pass
+    agent._step = start + env_steps.value
+    logger.step = config.action_repeat * agent._step
+    if updates.value < ratio * env_steps.value:
+      agent._train(next(agent._dataset))
+      with updates.get_lock():
+        updates.value += 1
+      if updates.value % config.actor_sync_every == 0:
+        with lock:
+          for key, value in policy_weights(agent).items():
+            weights[key].copy_(value)
+          version.value += 1
+      if agent._should_log(agent._step):
+        agent._write_metrics()
+    if should_eval(agent._step):
+      print('Start evaluation.')
+      video_pred = agent._wm.video_pred(next(eval_dataset))
+      logger.video('eval_openl', to_np(video_pred))
+      eval_policy = functools.partial(agent, training = False)
+      tools.simulate(eval_policy, eval_envs, episodes = 1)
+      torch.save(agent.state_dict(), logdir / 'latest_model.pt')
+  stop.set()
+  for actor in actors:
+    actor.join(5)
+
+
+def train_offline(config, agent, logger, eval_envs, eval_dataset, logdir):
+  '''
+  Trains from the streamed offline dataset only, every update advances the
+  step by as many env steps as an update costs when collecting online.
+  '''
+  should_eval = tools.Every(config.eval_every)
+  steps_per_update = max(1, int(config.train_every / config.train_steps))
+  if agent._should_pretrain():
+    for _ in range(config.pretrain):
+      agent._train(next(agent._dataset))
+  while agent._step < config.steps:
+    agent._train(next(agent._dataset))
+    agent._step += steps_per_update
+    logger.step = config.action_repeat * agent._step
+    if agent._should_log(agent._step):
+      agent._write_metrics()
+    if should_eval(agent._step):
+      print('Start evaluation.')
+      video_pred = agent._wm.video_pred(next(eval_dataset))
+      logger.video('eval_openl', to_np(video_pred))
+      eval_policy = functools.partial(agent, training = False)
+      tools.simulate(eval_policy, eval_envs, episodes = 1)
+      torch.save(agent.state_dict(), logdir / 'latest_model.pt')
+
+
 def set_test_paramters(config):
   # For testing on my mac to prevent high ram usage
   config.debug = True
@@ -377,6 +629,7 @@ def set_test_paramters(config):
   config.batch_length = 20
 
 def main(config):
+  global episode_writer, recent_replay
   config_dict = config.__dict__
   config.task_type = '' # dmc or eempty string
   #dmc Humanoid-v4 'Hopper-v4'
@@ -410,12 +663,35 @@ def main(config):
   step = count_steps(config.traindir)
   logger = tools.Logger(logdir, config.action_repeat * step)
 
+  if config.episode_writers:
+    episode_writer = tools.EpisodeWriter(
+        config.episode_codec, config.episode_writers, config.episode_queue)
+
   print('Create envs.')
   if config.offline_traindir:
     directory = config.offline_traindir.format(**vars(config))
   else:
     directory = config.traindir
-  train_eps = tools.load_episodes(directory, limit=config.dataset_size)
+  if config.offline_stream:
+    assert config.offline_traindir, 'offline_stream streams offline_traindir'
+    stream_directory = directory
+    train_eps = {} # nothing is collected, the batches come from the files
+  elif config.replay == 'mmap':
+    train_eps = tools.ReplayStore(
+        config.traindir / 'replay', config.dataset_size or config.replay_capacity,
+        config.replay_chunk)
+    if not len(train_eps):
+      train_eps.extend(directory)
+  else:
+    train_eps = tools.load_episodes(
+        directory, limit=config.dataset_size, workers=config.load_workers,
+        min_steps=config.load_min_steps)
+
+  if config.recent_replay and not config.offline_stream:
+    recent_replay = tools.DeviceReplay(
+        config.recent_replay, config.batch_size, config.batch_length,
+        config.device, config.oversample_ends, config.seed)
+    recent_replay.extend(train_eps)
 
   if config.offline_evaldir:
     directory = config.offline_evaldir.format(**vars(config))
@@ -423,9 +699,16 @@ def main(config):
     directory = config.evaldir
 
   eval_eps = tools.load_episodes(directory, limit=1)
-  make = lambda mode: make_env(config, logger, mode, train_eps, eval_eps)
-  train_envs = [make('train') for _ in range(config.envs)]
-  eval_envs = [make('eval') for _ in range(config.envs)]
+  if config.parallel == 'none':
+    make = lambda mode: [
+        make_env(config, logger, mode, train_eps, eval_eps) for _ in range(config.envs)]
+  else:
+    constructors = [functools.partial(make_base_env, config)] * config.envs
+    make = lambda mode: [
+        make_env(config, logger, mode, train_eps, eval_eps, env)
+        for env in wrappers.Parallel(constructors, config.parallel).envs]
+  train_envs = make('train')
+  eval_envs = make('eval')
   acts = train_envs[0].action_space
   config.num_actions = acts.n if hasattr(acts, 'n') else acts.shape[0]
 
@@ -444,18 +727,44 @@ def main(config):
       return {'action': action, 'logprob': logprob, 'task_switch' : torch.tensor([0])}, None
     tools.simulate(random_agent, train_envs, prefill)
     tools.simulate(random_agent, eval_envs, episodes=1)
+    if episode_writer:
+      episode_writer.flush() # the step counts below read the train directory
     logger.step = config.action_repeat * count_steps(config.traindir)
 
   print('Simulate agent.')
-  train_dataset = make_dataset(train_eps, config)
+  train_dataset = make_dataset(
+      train_eps, config, stream_directory if config.offline_stream else None)
   eval_dataset = make_dataset(eval_eps, config)
+  # Dreamer turns the schedules of its config into closures
+  actor_config = copy.copy(config)
   #intialise world models, and imgination(actor, critic)
-  agent = Dreamer(config, logger, train_dataset).to(config.device)
+  agent = Dreamer(config, logger, train_dataset, recent_replay).to(config.device)
   agent.requires_grad_(requires_grad = False)
   if (logdir / 'latest_model.pt').exists():
     agent.load_state_dict(torch.load(logdir / 'latest_model.pt'))
     agent._should_pretrain._once = False
 
+  if config.offline_stream:
+    for env in train_envs:
+      env.close()
+    train_offline(config, agent, logger, eval_envs, eval_dataset, logdir)
+    for env in eval_envs:
+      env.close()
+    if episode_writer:
+      episode_writer.close()
+    return
+
+  if config.decoupled:
+    for env in train_envs:
+      env.close()
+    train_decoupled(config, actor_config, agent, logger, train_eps, eval_eps,
+                    eval_envs, eval_dataset, logdir)
+    for env in eval_envs:
+      env.close()
+    if episode_writer:
+      episode_writer.close()
+    return
+
   state = None
   while agent._step < config.steps:
     logger.write()
@@ -474,6 +783,8 @@ def main(config):
       env.close()
     except Exception:
       pass
+  if episode_writer:
+    episode_writer.close()
 
 
 if __name__ == '__main__':
@@ -7,7 +7,15 @@ from torch import distributions as torchd
 import ma_networks as networks
 import ma_tools as tools
 import torch.nn.functional as F
-to_np = lambda x: x.detach().cpu().numpy()
+# metrics stay on the device, Dreamer syncs them when it logs
+detach = lambda x: x.detach()
+
+
+def to_float(x):
+  # NumPy batches are copied, tensors of the device replay stay on the device
+  if torch.is_tensor(x):
+    return x.float()
+  return torch.tensor(x, dtype=torch.float32)
 
 
 class WorldModel(nn.Module):
@@ -15,7 +23,8 @@ class WorldModel(nn.Module):
   def __init__(self, step, config):
     super(WorldModel, self).__init__()
     self._step = step
-    self._use_amp = True if config.precision==16 else False
+    self._precision = tools.Precision(
+        config.precision, config.device, config.amp_dtype)
     self._config = config
     self.encoder = networks.ConvEncoder(config.grayscale,
         config.cnn_depth, config.act, config.encoder_kernels)
@@ -32,6 +41,7 @@ class WorldModel(nn.Module):
         config.act, config.dyn_mean_act, config.dyn_std_act,
         config.dyn_temp_post, config.dyn_min_std, config.dyn_cell,
         config.num_actions, embed_size, config.device)
+    self.dynamics.compile_steps(config.dyn_compile)
     
     self.heads = nn.ModuleDict()
 
@@ -60,13 +70,18 @@ class WorldModel(nn.Module):
           feat_size,  # pytorch version
           [], config.discount_layers, config.units, config.act, dist='binary')
       
+    if config.fused_scalar_heads:
+      # reward, cost and discount share one stacked MLP evaluation
+      self.scalar_heads = networks.fuse_scalar_heads(
+          self.heads, ['reward', 'cost', 'discount'])
+      self._register_load_state_dict_pre_hook(self._fuse_head_state)
     for name in config.grad_heads:
       assert name in self.heads, name # check if imagination model, reward and cost are compulsorily intalised
 
     self._model_opt = tools.Optimizer(
         'model', self.parameters(), config.model_lr, config.opt_eps, config.grad_clip,
         config.weight_decay, opt = config.opt,
-        use_amp = self._use_amp)
+        precision = self._precision)
     
     
     #MOD
@@ -75,9 +90,11 @@ class WorldModel(nn.Module):
 
   def _train(self, data):
     data = self.preprocess(data)
+    # frames arrive as uint8, the reconstruction target is normalised once
+    data = dict(data, image=networks.normalize_image(data['image']))
 
     with tools.RequiresGrad(self):
-      with torch.cuda.amp.autocast(self._use_amp):
+      with self._precision.autocast():
         embed = self.encoder(data)
         post, prior = self.dynamics.observe(embed, data['action'])
         kl_balance = tools.schedule(self._config.kl_balance, self._step)
@@ -87,11 +104,18 @@ class WorldModel(nn.Module):
             post, prior, self._config.kl_forward, kl_balance, kl_free, kl_scale)
         losses = {}
         likes = {}
+        # features of the posterior are built once for all heads
+        latent = self.dynamics.view(post)
+        scalar = {}
+        if self._config.fused_scalar_heads:
+          # one evaluation, heads outside grad_heads stop their own gradient
+          scalar = self.scalar_heads(latent.feat, stop=[
+              name for name in self.scalar_heads.names
+              if name not in self._config.grad_heads])
         for name, head in self.heads.items():
           grad_head = (name in self._config.grad_heads)
-          feat = self.dynamics.get_feat(post)
-          feat = feat if grad_head else feat.detach()
-          pred = head(feat)
+          feat = latent.feat if grad_head else latent.detached_feat
+          pred = scalar[name] if name in scalar else head(feat)
           like = pred.log_prob(data[name])
           likes[name] = like
           # scales was applied here
@@ -107,51 +131,72 @@ class WorldModel(nn.Module):
 
         #lagrangian_loss = 
       metrics = self._model_opt(model_loss, self.parameters())
+      if self._config.fused_scalar_heads:
+        self.scalar_heads.clear()
 
-    metrics.update({f'{name}_loss': to_np(loss) for name, loss in losses.items()})
+    metrics.update({f'{name}_loss': detach(loss) for name, loss in losses.items()})
     metrics['kl_balance'] = kl_balance
     metrics['kl_free'] = kl_free
     metrics['kl_scale'] = kl_scale
-    metrics['kl'] = to_np(torch.mean(kl_value))
+    metrics['kl'] = detach(torch.mean(kl_value))
     # if self._config.learnable_lagrange:
-    #   metrics['lagrangian_multiplier'] = to_np(self._lagrangian_multiplier)
-    with torch.cuda.amp.autocast(self._use_amp):
-      metrics['prior_ent'] = to_np(torch.mean(self.dynamics.get_dist(prior).entropy()))
-      metrics['post_ent'] = to_np(torch.mean(self.dynamics.get_dist(post).entropy()))
+    #   metrics['lagrangian_multiplier'] = detach(self._lagrangian_multiplier)
+    with self._precision.autocast():
+      metrics['prior_ent'] = detach(torch.mean(self.dynamics.view(prior).entropy))
+      metrics['post_ent'] = detach(torch.mean(latent.entropy))
       context = dict(
-          embed = embed, feat = self.dynamics.get_feat(post),
-          kl = kl_value, postent = self.dynamics.get_dist(post).entropy())
-    post = {k: v.detach() for k, v in post.items()}
+          embed = embed, feat = latent.feat,
+          kl = kl_value, postent = latent.entropy)
+    post = latent.detached
     return post, context, metrics
 
+  def _fuse_head_state(self, state_dict, prefix, *args):
+    # checkpoints saved with separate reward/cost/discount heads
+    self.scalar_heads.fuse_state_dict(
+        state_dict, prefix + 'heads.', prefix + 'scalar_heads.')
+
   def preprocess(self, obs):
+    # batches from tools.Prefetcher are already normalised and on the device,
+    # their frames still uint8
+    if torch.is_tensor(obs['image']):
+      return obs
+    obs = self.normalize(obs)
+    return {k: v.to(self._config.device) for k, v in obs.items()}
+
+  def normalize(self, obs):
     # convert mdps to tensor and normalise image observation
     obs = obs.copy()
-    obs['image'] = torch.Tensor(obs['image']) / 255.0 - 0.5
+    # uint8 frames are moved as they are and normalised on the device
+    image = obs['image']
+    if image.dtype != (torch.uint8 if torch.is_tensor(image) else np.uint8):
+      obs['image'] = to_float(image) / 255.0 - 0.5
+    elif not torch.is_tensor(image):
+      obs['image'] = torch.tensor(image)
 
     if self._config.clip_rewards == 'tanh':
-      obs['reward'] = torch.tanh(torch.Tensor(obs['reward'])).unsqueeze(-1)
+      obs['reward'] = torch.tanh(to_float(obs['reward'])).unsqueeze(-1)
     elif self._config.clip_rewards == 'identity':
-      obs['reward'] = torch.Tensor(obs['reward']).unsqueeze(-1)
+      obs['reward'] = to_float(obs['reward']).unsqueeze(-1)
     else:
       raise NotImplemented(f'{self._config.clip_rewards} is not implemented')
     
     if self._config.clip_costs == 'tanh':
-      obs['cost'] = torch.tanh(torch.Tensor(obs['cost'])).unsqueeze(-1)
+      obs['cost'] = torch.tanh(to_float(obs['cost'])).unsqueeze(-1)
 
     elif self._config.clip_costs == 'identity':
-      obs['cost'] = torch.Tensor(obs['cost']).unsqueeze(-1)
+      obs['cost'] = to_float(obs['cost']).unsqueeze(-1)
     else:
       raise NotImplemented(f'{self._config.clip_costs} is not implemented')
     
     if 'discount' in obs:
-      obs['discount'] *= self._config.discount
-      obs['discount'] = torch.Tensor(obs['discount']).unsqueeze(-1)
-    obs = {k: torch.Tensor(v).to(self._config.device) for k, v in obs.items()} # convert obs to tensor
+      # not in place, the batch arrays belong to the sampler
+      obs['discount'] = (to_float(obs['discount']) * self._config.discount).unsqueeze(-1)
+    obs = {k: v if k == 'image' else to_float(v) for k, v in obs.items()} # convert obs to tensor
     return obs
 
   def video_pred(self, data):
     data = self.preprocess(data)
+    data = dict(data, image=networks.normalize_image(data['image']))
     truth = data['image'][:6] + 0.5
     embed = self.encoder(data)
 
@@ -175,7 +220,8 @@ class ImagBehavior(nn.Module):
 
   def __init__(self, config, world_model, stop_grad_actor=True, reward=None, cost = None):
     super(ImagBehavior, self).__init__()
-    self._use_amp = True if config.precision==16 else False
+    self._precision = tools.Precision(
+        config.precision, config.device, config.amp_dtype)
     self._config = config
     self._world_model = world_model
     self._stop_grad_actor = stop_grad_actor
@@ -238,35 +284,57 @@ class ImagBehavior(nn.Module):
         
         self._updates = 0
 
-    kw = dict(wd = config.weight_decay, opt = config.opt, use_amp=self._use_amp) 
-    # Actors Optimisers
-    self._actor_opt = tools.Optimizer(
-        'actor', self.actor.parameters(), config.actor_lr, config.opt_eps, config.actor_grad_clip,
-        **kw)
-    
-    self._safe_actor_opt = tools.Optimizer(
-        'safe_actor', self.safe_actor.parameters(), config.safe_actor_lr, config.opt_eps, config.actor_grad_clip,
-        **kw)
-    
-    # Values Optimisers
-    self._value_opt = tools.Optimizer(
-        'value', self.value.parameters(), config.value_lr, config.opt_eps, config.value_grad_clip,
-        **kw)
-    
-    self._value_safe_opt = tools.Optimizer(
-        'value_safe', self.value_safe.parameters(), config.value_lr, config.opt_eps, config.value_grad_clip,
-        **kw)
-    
-    self._cost_value_opt = tools.Optimizer(
-          'cost_value', self.cost_value.parameters(), config.cost_value_lr, config.opt_eps, config.value_grad_clip,
+    # one roll out for both policies shares the img_step graph between the
+    # two actor losses, they need the single backward of the grouped step
+    assert config.grouped_behavior_opt or not config.fused_imagination, \
+        'fused_imagination needs grouped_behavior_opt'
+    kw = dict(wd = config.weight_decay, opt = config.opt, precision=self._precision) 
+    if config.grouped_behavior_opt:
+      # one backward and one step for all heads below
+      groups = [
+          dict(name='actor', parameters=self.actor.parameters(),
+               lr=config.actor_lr, clip=config.actor_grad_clip),
+          dict(name='safe_actor', parameters=self.safe_actor.parameters(),
+               lr=config.safe_actor_lr, clip=config.actor_grad_clip),
+          dict(name='value', parameters=self.value.parameters(),
+               lr=config.value_lr, clip=config.value_grad_clip),
+          dict(name='value_safe', parameters=self.value_safe.parameters(),
+               lr=config.value_lr, clip=config.value_grad_clip),
+          dict(name='cost_value', parameters=self.cost_value.parameters(),
+               lr=config.cost_value_lr, clip=config.value_grad_clip)]
+      if self._config.learn_discriminator:
+        groups.append(dict(
+            name='discriminator', parameters=self.discriminator.parameters(),
+            lr=config.discrimiator_lr, clip=config.discriminator_grad_clip))
+      self._behavior_opt = tools.GroupedOptimizer(
+          'behavior', groups, config.opt_eps, **kw)
+    else:
+      # Actors Optimisers
+      self._actor_opt = tools.Optimizer(
+          'actor', self.actor.parameters(), config.actor_lr, config.opt_eps, config.actor_grad_clip,
           **kw)
-    if self._config.learn_discriminator:
 
-      
-      self._discriminator_opt = tools.Optimizer(
-        'discriminator', self.discriminator.parameters(), config.discrimiator_lr, config.opt_eps, config.discriminator_grad_clip,
-          **kw
-      )
+      self._safe_actor_opt = tools.Optimizer(
+          'safe_actor', self.safe_actor.parameters(), config.safe_actor_lr, config.opt_eps, config.actor_grad_clip,
+          **kw)
+
+      # Values Optimisers
+      self._value_opt = tools.Optimizer(
+          'value', self.value.parameters(), config.value_lr, config.opt_eps, config.value_grad_clip,
+          **kw)
+
+      self._value_safe_opt = tools.Optimizer(
+          'value_safe', self.value_safe.parameters(), config.value_lr, config.opt_eps, config.value_grad_clip,
+          **kw)
+
+      self._cost_value_opt = tools.Optimizer(
+            'cost_value', self.cost_value.parameters(), config.cost_value_lr, config.opt_eps, config.value_grad_clip,
+            **kw)
+      if self._config.learn_discriminator:
+        self._discriminator_opt = tools.Optimizer(
+          'discriminator', self.discriminator.parameters(), config.discrimiator_lr, config.opt_eps, config.discriminator_grad_clip,
+            **kw
+        )
 
     # lagrange parameters and pid and initalisation
     self._declare_lagrnagian()
@@ -285,24 +353,67 @@ class ImagBehavior(nn.Module):
     mets_lag = self._update_lag(training_step, mean_ep_cost)
     metrics.update(mets_lag)
 
-    with tools.RequiresGrad(self.actor):
-      with torch.cuda.amp.autocast(self._use_amp): #prcesion
-        #imagination roll out
-        imag_feat, imag_state, imag_action = self._imagine(
-            start, self.actor, self._config.imag_horizon, repeats)
+    if self._config.fused_imagination:
+      with tools.RequiresGrad(self.actor), tools.RequiresGrad(self.safe_actor):
+        with self._precision.autocast(): #prcesion
+          # both policies in one roll out, control rows first then safe rows
+          feats, states, actions = self._imagine_both(
+              start, self._config.imag_horizon, repeats)
+          rewards = objective(feats, states, actions)
+          costs = constrain(feats, states, actions)
+          state_ents = self._world_model.dynamics.get_dist(states).entropy()
+
+          split = lambda x: torch.chunk(x, 2, 1)
+          imag_feat, safe_imag_feat = split(feats)
+          imag_action, safe_imag_action = split(actions)
+          imag_state = {k: split(v)[0] for k, v in states.items()}
+          safe_imag_state = {k: split(v)[1] for k, v in states.items()}
+          reward, reward_safe_policy = split(rewards)
+          cost = split(costs)[1]
+          state_ent, safe_state_ent = split(state_ents)
+
+          actor_ent = self.actor(imag_feat).entropy()
+          safe_actor_ent = self.safe_actor(safe_imag_feat).entropy()
+    else:
+      with tools.RequiresGrad(self.actor):
+        with self._precision.autocast(): #prcesion
+          #imagination roll out
+          imag_feat, imag_state, imag_action = self._imagine(
+              start, self.actor, self._config.imag_horizon, repeats)
 
-        reward = objective(imag_feat, imag_state, imag_action)
+          reward = objective(imag_feat, imag_state, imag_action)
 
-        actor_ent = self.actor(imag_feat).entropy()
+          actor_ent = self.actor(imag_feat).entropy()
 
-        state_ent = self._world_model.dynamics.get_dist(
-            imag_state).entropy()
-        
-        # Compute diffrent targets
-        target, weights = self._compute_target(
-            imag_feat, imag_state, imag_action, reward, actor_ent, state_ent,
-            self._config.slow_actor_target)
+          state_ent = self._world_model.dynamics.get_dist(
+              imag_state).entropy()
+
+      with tools.RequiresGrad(self.safe_actor):
+        with self._precision.autocast(): #prcesion
+
+          safe_imag_feat, safe_imag_state, safe_imag_action = self._imagine(
+                start, self.safe_actor, self._config.imag_horizon, repeats)
+          #reward under safe policy
+          reward_safe_policy = objective(safe_imag_feat, safe_imag_state, safe_imag_action)
+
+          cost = constrain(safe_imag_feat, safe_imag_state, safe_imag_action)
+
+
+          safe_actor_ent = self.safe_actor(safe_imag_feat).entropy()
+
+          safe_state_ent = self._world_model.dynamics.get_dist(
+              safe_imag_state).entropy()
 
+    # Compute diffrent targets, control in one lambda return, safe and cost in another
+    with self._precision.autocast():
+      (target, weights), (target_under_safe_policy, target_weights_), target_cost = \
+          self._compute_targets(
+              imag_feat, imag_state, reward, actor_ent, state_ent,
+              safe_imag_feat, safe_imag_state, reward_safe_policy, cost,
+              safe_actor_ent, safe_state_ent, self._config.slow_actor_target)
+
+    with tools.RequiresGrad(self.actor):
+      with self._precision.autocast(): #prcesion
         actor_loss, mets = self._compute_actor_loss(
             imag_feat, imag_state, imag_action, \
             target, actor_ent, state_ent, weights)
@@ -318,7 +429,7 @@ class ImagBehavior(nn.Module):
 
     #update Control Value fn
     with tools.RequiresGrad(self.value):
-      with torch.cuda.amp.autocast(self._use_amp):
+      with self._precision.autocast():
         value = self.value(value_input[:-1].detach())
         target = torch.stack(target, dim=1)
         value_loss = -value.log_prob(target.detach())
@@ -328,28 +439,7 @@ class ImagBehavior(nn.Module):
 
     # update Safe Actor
     with tools.RequiresGrad(self.safe_actor):
-      with torch.cuda.amp.autocast(self._use_amp): #prcesion
-
-        safe_imag_feat, safe_imag_state, safe_imag_action = self._imagine(
-              start, self.safe_actor, self._config.imag_horizon, repeats)
-        #reward under safe policy
-        reward_safe_policy = objective(safe_imag_feat, safe_imag_state, safe_imag_action)
-
-        cost = constrain(safe_imag_feat, safe_imag_state, safe_imag_action)
-
-
-        safe_actor_ent = self.safe_actor(safe_imag_feat).entropy()
-
-        safe_state_ent = self._world_model.dynamics.get_dist(
-            safe_imag_state).entropy()
-
-        target_under_safe_policy, target_weights_ = self._compute_safe_target(
-            safe_imag_feat, safe_imag_state, safe_imag_action, reward_safe_policy, safe_actor_ent, safe_state_ent,
-            self._config.slow_actor_target)
-        
-        target_cost = self._compute_target_cost(
-                safe_imag_feat, safe_imag_state, safe_imag_action, cost, self._config.slow_actor_target)
-
+      with self._precision.autocast(): #prcesion
         safe_actor_loss, mets = self._compute_safe_actor_loss( \
               safe_imag_feat, safe_imag_state, safe_imag_action, \
               target_cost, safe_actor_ent, safe_state_ent, target_weights_,\
@@ -359,7 +449,7 @@ class ImagBehavior(nn.Module):
         safe_value_input = safe_imag_feat
 
     with tools.RequiresGrad(self.cost_value):
-      with torch.cuda.amp.autocast(self._use_amp):
+      with self._precision.autocast():
         cost_value = self.cost_value(safe_value_input[:-1].detach())
         target_cost = torch.stack(target_cost, dim=1)
         cost_value_loss = -cost_value.log_prob(target_cost.detach())
@@ -368,7 +458,7 @@ class ImagBehavior(nn.Module):
         
     #update Control Value fn
     with tools.RequiresGrad(self.value_safe):
-      with torch.cuda.amp.autocast(self._use_amp):
+      with self._precision.autocast():
         value_safe = self.value_safe(safe_value_input[:-1].detach())
         target_under_safe_policy = torch.stack(target_under_safe_policy, dim=1)
         value_safe_loss = -value_safe.log_prob(target_under_safe_policy.detach())
@@ -378,24 +468,34 @@ class ImagBehavior(nn.Module):
 
     if self._config.learn_discriminator:
       with tools.RequiresGrad(self.discriminator):
-        with torch.cuda.amp.autocast(self._use_amp):
+        with self._precision.autocast():
           discrimiator_loss = self._compute_discrimiator_loss(safe_imag_action, safe_imag_feat,\
                                     imag_action, imag_feat )
         
 
-    metrics['reward_mean'] = to_np(torch.mean(reward))
-    metrics['reward_std'] = to_np(torch.std(reward))
+    metrics['reward_mean'] = detach(torch.mean(reward))
+    metrics['reward_std'] = detach(torch.std(reward))
 
     #MOD
-    metrics['cost_mean'] = to_np(torch.mean(cost))
-    metrics['cost_std'] = to_np(torch.std(cost))
+    metrics['cost_mean'] = detach(torch.mean(cost))
+    metrics['cost_std'] = detach(torch.std(cost))
 
 
-    metrics['actor_ent'] = to_np(torch.mean(actor_ent))
-    metrics['safe_actor_ent'] = to_np(torch.mean(safe_actor_ent))
-    metrics['mean_target'] = to_np(torch.mean(target.detach()))
-    metrics['max_target'] = to_np(torch.max(target.detach()))
-    metrics['std_target'] = to_np(torch.std(target.detach()))
+    metrics['actor_ent'] = detach(torch.mean(actor_ent))
+    metrics['safe_actor_ent'] = detach(torch.mean(safe_actor_ent))
+    metrics['mean_target'] = detach(torch.mean(target.detach()))
+    metrics['max_target'] = detach(torch.max(target.detach()))
+    metrics['std_target'] = detach(torch.std(target.detach()))
+
+    if self._config.grouped_behavior_opt:
+      losses = dict(
+          actor=actor_loss, safe_actor=safe_actor_loss, value=value_loss,
+          cost_value=cost_value_loss, value_safe=value_safe_loss)
+      if self._config.learn_discriminator:
+        losses['discriminator'] = discrimiator_loss
+      with tools.RequiresGrad(self):
+        metrics.update(self._behavior_opt(losses))
+      return imag_feat, imag_state, imag_action, weights, metrics
 
     with tools.RequiresGrad(self):
       metrics.update(self._actor_opt(actor_loss, self.actor.parameters()))
@@ -432,18 +532,101 @@ class ImagBehavior(nn.Module):
 
     return feats, states, actions
 
+  def _imagine_both(self, start, horizon, repeats=None):
+    '''
+    Imagines the control and the safe policy from the same start states in
+    one roll out of twice the batch. The first half of the rows follows
+    the actor and the second half the safe actor.
+    '''
+    dynamics = self._world_model.dynamics
+    if repeats:
+      raise NotImplemented("repeats is not implemented in this version")
+    flatten = lambda x: x.reshape([-1] + list(x.shape[2:]))
+    start = {k: flatten(v) for k, v in start.items()}
+    start = {k: torch.cat([v, v], 0) for k, v in start.items()}
+    batch = start['deter'].shape[0] // 2
+    def policy(inp, method):
+      control = getattr(self.actor(inp[:batch]), method)()
+      safe = getattr(self.safe_actor(inp[batch:]), method)()
+      return torch.cat([control, safe], 0)
+    def step(prev, _):
+      state, _, _ = prev
+      feat = dynamics.get_feat(state)
+      inp = feat.detach() if self._stop_grad_actor else feat
+      action = policy(inp, 'sample')
+      succ = dynamics.img_step(state, action, sample=self._config.imag_sample)
+      return succ, feat, action
+    feat = 0 * dynamics.get_feat(start)
+    action = policy(feat, 'mode')
+    succ, feats, actions = tools.static_scan(
+        step, [torch.arange(horizon)], (start, feat, action))
+    states = {k: torch.cat([
+        start[k][None], v[:-1]], 0) for k, v in succ.items()}
+    return feats, states, actions
+
+  def _compute_targets(
+      self, imag_feat, imag_state, reward, actor_ent, state_ent,
+      safe_imag_feat, safe_imag_state, reward_safe, cost, safe_actor_ent,
+      safe_state_ent, slow):
+    '''
+    Same results as _compute_target, _compute_safe_target and
+    _compute_target_cost from two lambda returns: one for the control
+    roll out and one over the safe reward and cost stacked into [H, B, 2].
+    The two stay separate graphs, the actor and the safe actor losses are
+    backpropagated one after the other.
+    '''
+    discount = self._discount(imag_feat, reward)
+    safe_discount = self._discount(safe_imag_feat, cost)
+    # out of place, with fused imagination these are views of one chunked tensor
+    if self._config.future_entropy and self._config.actor_entropy() > 0:
+      reward = reward + self._config.actor_entropy() * actor_ent
+      reward_safe = reward_safe + self._config.actor_entropy() * safe_actor_ent
+    if self._config.future_entropy and self._config.actor_state_entropy() > 0:
+      reward = reward + self._config.actor_state_entropy() * state_ent
+      reward_safe = reward_safe + self._config.actor_state_entropy() * safe_state_ent
+    if slow:
+      value = self._slow_value(imag_feat)
+      safe_values = [self._slow_value_safe(safe_imag_feat), self._slow_cost_value(safe_imag_feat)]
+    else:
+      value = self.value(imag_feat)
+      safe_values = [self.value_safe(safe_imag_feat), self.cost_value(safe_imag_feat)]
+    value = value.mode()
+    target = tools.scan_layout(tools.lambda_returns(
+        reward[:-1], value[:-1], discount[:-1], value[-1],
+        self._config.discount_lambda))
+    safe_value = torch.cat([v.mode() for v in safe_values], -1)
+    safe_rewards = torch.cat([reward_safe, cost], -1)
+    safe_discounts = torch.cat([safe_discount, safe_discount], -1)
+    returns = tools.lambda_returns(
+        safe_rewards[:-1], safe_value[:-1], safe_discounts[:-1], safe_value[-1],
+        self._config.discount_lambda)
+    target_safe, target_cost = [
+        tools.scan_layout(returns[..., i: i + 1]) for i in range(2)]
+    weights = torch.cumprod(
+        torch.cat([torch.ones_like(discount[:1]), discount[:-1]], 0), 0).detach()
+    safe_weights = torch.cumprod(
+        torch.cat([torch.ones_like(safe_discount[:1]), safe_discount[:-1]], 0), 0).detach()
+    return (target, weights), (target_safe, safe_weights), target_cost
+
+  def _discount(self, imag_feat, like):
+    if 'discount' in self._world_model.heads:
+      inp = imag_feat
+      return self._world_model.heads['discount'](inp).mean
+    return self._config.discount * torch.ones_like(like)
+
   def _compute_target(
       self, imag_feat, imag_state, imag_action, reward, actor_ent, state_ent,
       slow,):
     if 'discount' in self._world_model.heads:
-      inp = self._world_model.dynamics.get_feat(imag_state)
+      inp = imag_feat
       discount = self._world_model.heads['discount'](inp).mean
     else:
       discount = self._config.discount * torch.ones_like(reward)
+    # out of place, reward may be a chunked view and is logged by the caller
     if self._config.future_entropy and self._config.actor_entropy() > 0:
-      reward += self._config.actor_entropy() * actor_ent
+      reward = reward + self._config.actor_entropy() * actor_ent
     if self._config.future_entropy and self._config.actor_state_entropy() > 0:
-      reward += self._config.actor_state_entropy() * state_ent
+      reward = reward + self._config.actor_state_entropy() * state_ent
     if slow:
       value = self._slow_value(imag_feat).mode()
     else:
@@ -463,14 +646,15 @@ class ImagBehavior(nn.Module):
     '''
   
     if 'discount' in self._world_model.heads:
-      inp = self._world_model.dynamics.get_feat(imag_state)
+      inp = imag_feat
       discount = self._world_model.heads['discount'](inp).mean
     else:
       discount = self._config.discount * torch.ones_like(reward)
+    # out of place, reward may be a chunked view and is logged by the caller
     if self._config.future_entropy and self._config.actor_entropy() > 0:
-      reward += self._config.actor_entropy() * actor_ent
+      reward = reward + self._config.actor_entropy() * actor_ent
     if self._config.future_entropy and self._config.actor_state_entropy() > 0:
-      reward += self._config.actor_state_entropy() * state_ent
+      reward = reward + self._config.actor_state_entropy() * state_ent
     if slow:
       value = self._slow_value_safe(imag_feat).mode()
     else:
@@ -485,7 +669,7 @@ class ImagBehavior(nn.Module):
   def _compute_target_cost(
       self, imag_feat, imag_state, imag_action, cost, slow):
     if 'discount' in self._world_model.heads:
-      inp = self._world_model.dynamics.get_feat(imag_state)
+      inp = imag_feat
       discount = self._world_model.heads['discount'](inp).mean
     else:
       discount = self._config.discount * torch.ones_like(cost)
@@ -633,21 +817,21 @@ class ImagBehavior(nn.Module):
       safe_actor_target /= penalty
 
     if self._config.behavior_cloning != '':
-      metrics['behavior_cloning_loss_mean'] = to_np(torch.mean(behavior_loss))
-      metrics['behavior_cloning_loss_min'] = to_np(torch.min(behavior_loss))
-      metrics['behavior_cloning__loss_max'] = to_np(torch.max(behavior_loss))
-      metrics['scaled_behavior_cloning_loss_mean'] = to_np(torch.mean(scaled_behavior_loss))
+      metrics['behavior_cloning_loss_mean'] = detach(torch.mean(behavior_loss))
+      metrics['behavior_cloning_loss_min'] = detach(torch.min(behavior_loss))
+      metrics['behavior_cloning__loss_max'] = detach(torch.max(behavior_loss))
+      metrics['scaled_behavior_cloning_loss_mean'] = detach(torch.mean(scaled_behavior_loss))
     else:
       metrics['behavior_cloning_loss_mean'] = 0
       metrics['behavior_cloning__loss_max'] = 0
       metrics['scaled_behavior_cloning_loss_mean'] = 0
 
     if self._config.conditional_cloning :
-      metrics['batches_using_kl_Loss'] = to_np(torch.sum(threshold_mask))
-    metrics['mean_target_under_safe_policy'] = to_np(torch.mean(target_under_safe_policy))
-    metrics['max_target_under_safe_policy'] = to_np(torch.max(target_under_safe_policy))
-    metrics['mean_target_cost'] = to_np(torch.mean(target_cost.detach()))
-    metrics['max_target_cost'] = to_np(torch.max(target_cost.detach()))
+      metrics['batches_using_kl_Loss'] = detach(torch.sum(threshold_mask))
+    metrics['mean_target_under_safe_policy'] = detach(torch.mean(target_under_safe_policy))
+    metrics['max_target_under_safe_policy'] = detach(torch.max(target_under_safe_policy))
+    metrics['mean_target_cost'] = detach(torch.mean(target_cost.detach()))
+    metrics['max_target_cost'] = detach(torch.max(target_cost.detach()))
     safe_actor_loss = torch.mean(weights[:-1] * safe_actor_target)
     return safe_actor_loss, metrics
 
@@ -760,9 +944,9 @@ class ImagBehavior(nn.Module):
   def _update_lag(self, training_step, mean_ep_cost, target_cost = None):
     metrics = {}
     if not self._config.use_pid:
-      metrics['lagrangian_multiplier'] = self._lagrangian_multiplier.detach().item() if self._config.learnable_lagrange else self._lagrangian_multiplier
+      metrics['lagrangian_multiplier'] = self._lagrangian_multiplier.detach() if self._config.learnable_lagrange else self._lagrangian_multiplier
 
-      metrics['lagrangian_multiplier_projected'] = self._lambda_range_projection(self._lagrangian_multiplier).detach().item() if self._config.learnable_lagrange else self._lagrangian_multiplier
+      metrics['lagrangian_multiplier_projected'] = self._lambda_range_projection(self._lagrangian_multiplier).detach() if self._config.learnable_lagrange else self._lagrangian_multiplier
     # if training_step > self._config.limit_decay_start and training_step % 20_000 == 0 and (abs(self.cost_limit - mean_ep_cost) == 5 or mean_ep_cost <= self.cost_limit):
       if training_step > self._config.limit_decay_start and training_step % self._config.limit_decay_freq == 0 and  mean_ep_cost < self.cost_limit:
         # self.cost_limit = self._cost_limit(training_step)
@@ -5,7 +5,15 @@ from PIL import ImageColor, Image, ImageDraw, ImageFont
 
 import ma_networks as networks
 import ma_tools as tools
-to_np = lambda x: x.detach().cpu().numpy()
+# metrics stay on the device, Dreamer syncs them when it logs
+detach = lambda x: x.detach()
+
+
+def to_float(x):
+  # NumPy batches are copied, tensors of the device replay stay on the device
+  if torch.is_tensor(x):
+    return x.float()
+  return torch.tensor(x, dtype=torch.float32)
 
 
 class WorldModel(nn.Module):
@@ -13,7 +21,8 @@ class WorldModel(nn.Module):
   def __init__(self, step, config):
     super(WorldModel, self).__init__()
     self._step = step
-    self._use_amp = True if config.precision==16 else False
+    self._precision = tools.Precision(
+        config.precision, config.device, config.amp_dtype)
     self._config = config
     self.encoder = networks.ConvEncoder(config.grayscale,
         config.cnn_depth, config.act, config.encoder_kernels)
@@ -29,6 +38,7 @@ class WorldModel(nn.Module):
         config.act, config.dyn_mean_act, config.dyn_std_act,
         config.dyn_temp_post, config.dyn_min_std, config.dyn_cell,
         config.num_actions, embed_size, config.device)
+    self.dynamics.compile_steps(config.dyn_compile)
     self.heads = nn.ModuleDict()
     channels = (1 if config.grayscale else 3)
     shape = (channels,) + config.size
@@ -52,20 +62,27 @@ class WorldModel(nn.Module):
       self.heads['discount'] = networks.DenseHead(
           feat_size,  # pytorch version
           [], config.discount_layers, config.units, config.act, dist='binary')
+    if config.fused_scalar_heads:
+      # reward, cost and discount share one stacked MLP evaluation
+      self.scalar_heads = networks.fuse_scalar_heads(
+          self.heads, ['reward', 'cost', 'discount'])
+      self._register_load_state_dict_pre_hook(self._fuse_head_state)
     for name in config.grad_heads:
       assert name in self.heads, name
     self._model_opt = tools.Optimizer(
         'model', self.parameters(), config.model_lr, config.opt_eps, config.grad_clip,
         config.weight_decay, opt=config.opt,
-        use_amp=self._use_amp)
+        precision=self._precision)
     self._scales = dict(
         reward=config.reward_scale, discount=config.discount_scale, cost = config.cost_scale)
 
   def _train(self, data):
     data = self.preprocess(data)
+    # frames arrive as uint8, the reconstruction target is normalised once
+    data = dict(data, image=networks.normalize_image(data['image']))
 
     with tools.RequiresGrad(self):
-      with torch.cuda.amp.autocast(self._use_amp):
+      with self._precision.autocast():
         embed = self.encoder(data)
         post, prior = self.dynamics.observe(embed, data['action'])
         kl_balance = tools.schedule(self._config.kl_balance, self._step)
@@ -75,55 +92,83 @@ class WorldModel(nn.Module):
             post, prior, self._config.kl_forward, kl_balance, kl_free, kl_scale)
         losses = {}
         likes = {}
+        # features of the posterior are built once for all heads
+        latent = self.dynamics.view(post)
+        scalar = {}
+        if self._config.fused_scalar_heads:
+          # one evaluation, heads outside grad_heads stop their own gradient
+          scalar = self.scalar_heads(latent.feat, stop=[
+              name for name in self.scalar_heads.names
+              if name not in self._config.grad_heads])
         for name, head in self.heads.items():
           grad_head = (name in self._config.grad_heads)
-          feat = self.dynamics.get_feat(post)
-          feat = feat if grad_head else feat.detach()
-          pred = head(feat)
+          feat = latent.feat if grad_head else latent.detached_feat
+          pred = scalar[name] if name in scalar else head(feat)
           like = pred.log_prob(data[name])
           likes[name] = like
           losses[name] = -torch.mean(like) * self._scales.get(name, 1.0)
         model_loss = sum(losses.values()) + kl_loss
       metrics = self._model_opt(model_loss, self.parameters())
+      if self._config.fused_scalar_heads:
+        self.scalar_heads.clear()
 
-    metrics.update({f'{name}_loss': to_np(loss) for name, loss in losses.items()})
+    metrics.update({f'{name}_loss': detach(loss) for name, loss in losses.items()})
     metrics['kl_balance'] = kl_balance
     metrics['kl_free'] = kl_free
     metrics['kl_scale'] = kl_scale
-    metrics['kl'] = to_np(torch.mean(kl_value))
-    with torch.cuda.amp.autocast(self._use_amp):
-      metrics['prior_ent'] = to_np(torch.mean(self.dynamics.get_dist(prior).entropy()))
-      metrics['post_ent'] = to_np(torch.mean(self.dynamics.get_dist(post).entropy()))
+    metrics['kl'] = detach(torch.mean(kl_value))
+    with self._precision.autocast():
+      metrics['prior_ent'] = detach(torch.mean(self.dynamics.view(prior).entropy))
+      metrics['post_ent'] = detach(torch.mean(latent.entropy))
       context = dict(
-          embed=embed, feat=self.dynamics.get_feat(post),
-          kl=kl_value, postent=self.dynamics.get_dist(post).entropy())
-    post = {k: v.detach() for k, v in post.items()}
+          embed=embed, feat=latent.feat,
+          kl=kl_value, postent=latent.entropy)
+    post = latent.detached
     return post, context, metrics
 
+  def _fuse_head_state(self, state_dict, prefix, *args):
+    # checkpoints saved with separate reward/cost/discount heads
+    self.scalar_heads.fuse_state_dict(
+        state_dict, prefix + 'heads.', prefix + 'scalar_heads.')
+
   def preprocess(self, obs):
+    # batches from tools.Prefetcher are already normalised and on the device,
+    # their frames still uint8
+    if torch.is_tensor(obs['image']):
+      return obs
+    obs = self.normalize(obs)
+    return {k: v.to(self._config.device) for k, v in obs.items()}
+
+  def normalize(self, obs):
     obs = obs.copy()
-    obs['image'] = torch.Tensor(obs['image']) / 255.0 - 0.5
+    # uint8 frames are moved as they are and normalised on the device
+    image = obs['image']
+    if image.dtype != (torch.uint8 if torch.is_tensor(image) else np.uint8):
+      obs['image'] = to_float(image) / 255.0 - 0.5
+    elif not torch.is_tensor(image):
+      obs['image'] = torch.tensor(image)
     if self._config.clip_rewards == 'tanh':
-      obs['reward'] = torch.tanh(torch.Tensor(obs['reward'])).unsqueeze(-1)
+      obs['reward'] = torch.tanh(to_float(obs['reward'])).unsqueeze(-1)
     elif self._config.clip_rewards == 'identity':
-      obs['reward'] = torch.Tensor(obs['reward']).unsqueeze(-1)
+      obs['reward'] = to_float(obs['reward']).unsqueeze(-1)
     else:
       raise NotImplemented(f'{self._config.clip_rewards} is not implemented')
     if self._config.clip_costs == 'tanh':
-      obs['cost'] = torch.tanh(torch.Tensor(obs['cost'])).unsqueeze(-1)
+      obs['cost'] = torch.tanh(to_float(obs['cost'])).unsqueeze(-1)
     elif self._config.clip_costs == 'identity':
-      obs['cost'] = torch.Tensor(obs['cost']).unsqueeze(-1)
+      obs['cost'] = to_float(obs['cost']).unsqueeze(-1)
     else:
       raise NotImplemented(f'{self._config.clip_costs} is not implemented')
     
     if 'discount' in obs:
-      obs['discount'] *= self._config.discount
-      obs['discount'] = torch.Tensor(obs['discount']).unsqueeze(-1)
-    obs = {k: torch.Tensor(v).to(self._config.device) for k, v in obs.items()}
+      # not in place, the batch arrays belong to the sampler
+      obs['discount'] = (to_float(obs['discount']) * self._config.discount).unsqueeze(-1)
+    obs = {k: v if k == 'image' else to_float(v) for k, v in obs.items()}
     return obs
 
   def video_pred(self, data):
     data = self.preprocess(data)
+    data = dict(data, image=networks.normalize_image(data['image']))
     truth = data['image'][:6] + 0.5
     embed = self.encoder(data)
 
@@ -146,7 +191,8 @@ class ImagBehavior(nn.Module):
 
   def __init__(self, config, world_model, stop_grad_actor=True, reward=None, cost = None):
     super(ImagBehavior, self).__init__()
-    self._use_amp = True if config.precision==16 else False
+    self._precision = tools.Precision(
+        config.precision, config.device, config.amp_dtype)
     self._config = config
     self._world_model = world_model
     self._stop_grad_actor = stop_grad_actor
@@ -200,7 +246,7 @@ class ImagBehavior(nn.Module):
         
         self._updates = 0
 
-    kw = dict(wd=config.weight_decay, opt=config.opt, use_amp=self._use_amp)
+    kw = dict(wd=config.weight_decay, opt=config.opt, precision=self._precision)
 
     self._actor_opt = tools.Optimizer(
         'actor', self.actor.parameters(), config.actor_lr, config.opt_eps, config.actor_grad_clip,
@@ -229,7 +275,7 @@ class ImagBehavior(nn.Module):
     metrics = {}
 
     with tools.RequiresGrad(self.actor):
-      with torch.cuda.amp.autocast(self._use_amp):
+      with self._precision.autocast():
         imag_feat, imag_state, imag_action = self._imagine(
             start, self.actor, self._config.imag_horizon, repeats)
         reward = objective(imag_feat, imag_state, imag_action)
@@ -250,7 +296,7 @@ class ImagBehavior(nn.Module):
         value_input = imag_feat
 
     with tools.RequiresGrad(self.value):
-      with torch.cuda.amp.autocast(self._use_amp):
+      with self._precision.autocast():
         value = self.value(value_input[:-1].detach())
         target = torch.stack(target, dim=1)
         value_loss = -value.log_prob(target.detach())
@@ -259,7 +305,7 @@ class ImagBehavior(nn.Module):
         value_loss = torch.mean(weights[:-1] * value_loss[:,:,None])
 
     with tools.RequiresGrad(self.safe_actor):
-      with torch.cuda.amp.autocast(self._use_amp):
+      with self._precision.autocast():
         safe_imag_feat, safe_imag_state, safe_imag_action = self._imagine(
             start, self.safe_actor, self._config.imag_horizon, repeats)
         #compute cost and reward from safe actor rollouts
@@ -290,7 +336,7 @@ class ImagBehavior(nn.Module):
         value_safep_input = safe_imag_feat
 
     with tools.RequiresGrad(self.value_safep):
-        with torch.cuda.amp.autocast(self._use_amp):
+        with self._precision.autocast():
             value_safep = self.value_safep(value_safep_input[:-1].detach())
             target_safep = torch.stack(target_safep, dim=1)
             value_safep_loss = -value_safep.log_prob(target_safep.detach())
@@ -298,13 +344,13 @@ class ImagBehavior(nn.Module):
                 value_safep_loss += self._config.value_decay * value_safep.mode()
             value_safep_loss = torch.mean(weights[:-1] * value_safep_loss[:,:,None])
 
-    metrics['reward_mean'] = to_np(torch.mean(reward))
-    metrics['reward_under_safep_mean'] = to_np(torch.mean(reward_safep))
-    metrics['reward_std'] = to_np(torch.std(reward))
-    metrics['actor_ent'] = to_np(torch.mean(actor_ent))
-    metrics['safe_actor_ent'] = to_np(torch.mean(safe_actor_ent))
-    metrics['mean_target'] = to_np(torch.mean(target.detach()))
-    metrics['max_target'] = to_np(torch.max(target.detach()))
+    metrics['reward_mean'] = detach(torch.mean(reward))
+    metrics['reward_under_safep_mean'] = detach(torch.mean(reward_safep))
+    metrics['reward_std'] = detach(torch.std(reward))
+    metrics['actor_ent'] = detach(torch.mean(actor_ent))
+    metrics['safe_actor_ent'] = detach(torch.mean(safe_actor_ent))
+    metrics['mean_target'] = detach(torch.mean(target.detach()))
+    metrics['max_target'] = detach(torch.max(target.detach()))
     with tools.RequiresGrad(self):
         metrics.update(self._actor_opt(actor_loss, self.actor.parameters()))
         metrics.update(self._value_opt(value_loss, self.value.parameters()))
@@ -341,7 +387,7 @@ class ImagBehavior(nn.Module):
       self, imag_feat, imag_state, imag_action, reward, actor_ent, state_ent,
       slow):
     if 'discount' in self._world_model.heads:
-      inp = self._world_model.dynamics.get_feat(imag_state)
+      inp = imag_feat
       discount = self._world_model.heads['discount'](inp).mean
     else:
       discount = self._config.discount * torch.ones_like(reward)
@@ -364,7 +410,7 @@ class ImagBehavior(nn.Module):
       self, imag_feat, imag_state, imag_action, cost, actor_ent, state_ent,
       slow):
     if 'discount' in self._world_model.heads:
-      inp = self._world_model.dynamics.get_feat(imag_state)
+      inp = imag_feat
       discount = self._world_model.heads['discount'](inp).mean
     else:
       discount = self._config.discount * torch.ones_like(cost)
@@ -392,9 +438,9 @@ class ImagBehavior(nn.Module):
         actor_ent = policy.entropy()
         target = torch.stack(target, dim=1)
         target_cost = torch.stack(target_cost, dim=1)
-        metrics["mean_target_under_safe_policy"] = to_np(torch.mean(target))
-        metrics["mean_target_cost"] = to_np(torch.mean(target_cost))
-        metrics["max_target_cost"] = to_np(torch.mean(target_cost))
+        metrics["mean_target_under_safe_policy"] = detach(torch.mean(target))
+        metrics["mean_target_cost"] = detach(torch.mean(target_cost))
+        metrics["max_target_cost"] = detach(torch.mean(target_cost))
         actor_target = self._config.alpha1  * target
         actor_target -= self._config.alpha2 * target_cost
 
@@ -1,3 +1,5 @@
+import collections
+
 import numpy as np
 
 import torch
@@ -32,6 +34,7 @@ class RSSM(nn.Module):
     self._temp_post = temp_post
     self._embed = embed
     self._device = device
+    self._compiled = {}
 
     inp_layers = []
     if self._discrete:
@@ -51,6 +54,10 @@ class RSSM(nn.Module):
       self._cell = GRUCell(self._hidden, self._deter)
     elif cell == 'gru_layer_norm':
       self._cell = GRUCell(self._hidden, self._deter, norm=True)
+    elif cell == 'gru_fused':
+      self._cell = GRUCell(self._hidden, self._deter, fused=True)
+    elif cell == 'gru_layer_norm_fused':
+      self._cell = GRUCell(self._hidden, self._deter, norm=True, fused=True)
     else:
       raise NotImplementedError(cell)
 
@@ -122,6 +129,10 @@ class RSSM(nn.Module):
     prior = {k: swap(v) for k, v in prior.items()}
     return prior
 
+  def view(self, state, feat=None):
+    '''Memoizing LatentView of a state, feat if it is already known.'''
+    return LatentView(self, state, feat)
+
   def get_feat(self, state):
     stoch = state['stoch']
     if self._discrete:
@@ -139,13 +150,71 @@ class RSSM(nn.Module):
           torchd.normal.Normal(mean, std), 1))
     return dist
 
+  def compile_steps(self, mode='none', warmup=2, max_shapes=4):
+    '''
+    Routes img_step and obs_step through torch.compile for fixed shapes.
+    - compile builds a plain compiled graph
+    - cudagraph also captures CUDA graphs (reduce-overhead) on the gpu and
+      is a plain compile elsewhere
+    A shape is only compiled once it was seen warmup times and at most
+    max_shapes shapes get compiled, any other shape runs eagerly instead
+    of triggering another recompile.
+    '''
+    self._compiled = {}
+    if mode == 'none':
+      return
+    if mode not in ('compile', 'cudagraph'):
+      raise NotImplementedError(mode)
+    if not hasattr(torch, 'compile'):
+      raise NotImplementedError('compiled rssm steps need torch 2')
+    options = {}
+    if mode == 'cudagraph' and torch.device(self._device).type == 'cuda':
+      options['mode'] = 'reduce-overhead'
+    self._cudagraph = 'mode' in options
+    self._compiled = {
+        'img': torch.compile(self._img_step, dynamic=False, **options),
+        'obs': torch.compile(self._obs_step, dynamic=False, **options)}
+    self._warmup = warmup
+    self._max_shapes = max_shapes
+    self._seen = collections.Counter()
+    self._shapes = set()
+
+  def _run(self, name, eager, key, *args):
+    if name not in self._compiled:
+      return eager(*args)
+    key = (name, torch.is_grad_enabled()) + key
+    if key not in self._shapes:
+      self._seen[key] += 1
+      if self._seen[key] <= self._warmup or len(self._shapes) >= self._max_shapes:
+        return eager(*args)
+      self._shapes.add(key)
+    outputs = self._compiled[name](*args)
+    if self._cudagraph:
+      # graph outputs are overwritten by the next replay, the scans keep them
+      clone = lambda state: {k: v.clone() for k, v in state.items()}
+      outputs = tuple(map(clone, outputs)) if name == 'obs' else clone(outputs)
+    return outputs
+
   def obs_step(self, prev_state, prev_action, embed, sample=True):
     '''
     retruns posterior and prior 
     '''
-    prior = self.img_step(prev_state, prev_action, None, sample)
+    key = (tuple(prev_action.shape), tuple(embed.shape), prev_action.dtype, sample)
+    return self._run(
+        'obs', self._obs_step, key, prev_state, prev_action, embed, sample)
+
+  def img_step(self, prev_state, prev_action, embed=None, sample=True):
+    '''
+    returns succesive states prior
+    '''
+    key = (tuple(prev_action.shape), embed is None, prev_action.dtype, sample)
+    return self._run(
+        'img', self._img_step, key, prev_state, prev_action, embed, sample)
+
+  def _obs_step(self, prev_state, prev_action, embed, sample=True):
+    prior = self._img_step(prev_state, prev_action, None, sample)
     if self._shared:
-      post = self.img_step(prev_state, prev_action, embed, sample)
+      post = self._img_step(prev_state, prev_action, embed, sample)
     else:
       if self._temp_post:
         x = torch.cat([prior['deter'], embed], -1)
@@ -160,10 +229,7 @@ class RSSM(nn.Module):
       post = {'stoch': stoch, 'deter': prior['deter'], **stats}
     return post, prior
 
-  def img_step(self, prev_state, prev_action, embed=None, sample=True):
-    '''
-    returns succesive states prior
-    '''
+  def _img_step(self, prev_state, prev_action, embed=None, sample=True):
     prev_stoch = prev_state['stoch']
     if self._discrete:
       shape = list(prev_stoch.shape[:-2]) + [self._stoch * self._discrete]
@@ -242,6 +308,57 @@ class RSSM(nn.Module):
     return loss, value
 
 
+class LatentView:
+  '''
+  One state dict of an update seen through the RSSM, every derived tensor
+  is built on first use and then shared by all heads that need it:
+  - feat and its detached copy
+  - the distribution and its entropy
+  - the detached state
+  '''
+
+  def __init__(self, dynamics, state, feat=None):
+    self.state = state
+    self._dynamics = dynamics
+    self._cache = {} if feat is None else {'feat': feat}
+
+  def _memo(self, name, build):
+    if name not in self._cache:
+      self._cache[name] = build()
+    return self._cache[name]
+
+  @property
+  def feat(self):
+    return self._memo('feat', lambda: self._dynamics.get_feat(self.state))
+
+  @property
+  def detached_feat(self):
+    return self._memo('detached_feat', lambda: self.feat.detach())
+
+  @property
+  def dist(self):
+    return self._memo('dist', lambda: self._dynamics.get_dist(self.state))
+
+  @property
+  def entropy(self):
+    return self._memo('entropy', lambda: self.dist.entropy())
+
+  @property
+  def detached(self):
+    return self._memo(
+        'detached', lambda: {k: v.detach() for k, v in self.state.items()})
+
+
+def normalize_image(image):
+  '''
+  uint8 frames to floats in [-0.5, 0.5] on whatever device they are on.
+  Float images were normalised on the host already and pass through.
+  '''
+  if image.dtype != torch.uint8:
+    return image
+  return image.float().mul_(1 / 255.0).sub_(0.5)
+
+
 class ConvEncoder(nn.Module):
 
   def __init__(self, grayscale=False,
@@ -267,7 +384,8 @@ class ConvEncoder(nn.Module):
 
   def __call__(self, obs):
     x = obs['image'].reshape((-1,) + tuple(obs['image'].shape[-3:]))
-    x = x.permute(0, 3, 1, 2)
+    # uint8 frames are normalised here, after the copy to the device
+    x = normalize_image(x.permute(0, 3, 1, 2))
     x = self.layers(x)
     x = x.reshape([x.shape[0], np.prod(x.shape[1:])])
     shape = list(obs['image'].shape[:-3]) + [x.shape[-1]]
@@ -360,16 +478,185 @@ class DenseHead(nn.Module):
       std = torch.softplus(std) + 0.01
     else:
       std = self._std
-    if self._dist == 'normal':
-      return tools.ContDist(torchd.independent.Independent(
-        torchd.normal.Normal(mean, std), len(self._shape)))
-    if self._dist == 'huber':
-      return tools.ContDist(torchd.independent.Independent(
-          tools.UnnormalizedHuber(mean, std, 1.0), len(self._shape)))
-    if self._dist == 'binary':
-      return tools.Bernoulli(torchd.independent.Independent(
-        torchd.bernoulli.Bernoulli(logits=mean), len(self._shape)))
-    raise NotImplementedError(self._dist)
+    return dense_dist(mean, std, self._dist, len(self._shape))
+
+
+def dense_dist(mean, std, dist, event_dims):
+  if dist == 'normal':
+    return tools.ContDist(torchd.independent.Independent(
+      torchd.normal.Normal(mean, std), event_dims))
+  if dist == 'huber':
+    return tools.ContDist(torchd.independent.Independent(
+        tools.UnnormalizedHuber(mean, std, 1.0), event_dims))
+  if dist == 'binary':
+    return tools.Bernoulli(torchd.independent.Independent(
+      torchd.bernoulli.Bernoulli(logits=mean), event_dims))
+  raise NotImplementedError(dist)
+
+
+class ScalarHeads(nn.Module):
+  '''
+  Evaluates several scalar DenseHeads (reward, cost, discount) over the same
+  features as one stacked MLP per depth:
+  - the first layer of every head is one [inp, K*units] matmul,
+  - deeper layers are one batched matmul over [K, units, units],
+  - the output is [N, K] and is split into the usual per-head dists.
+  Heads of different depth cannot share layers and get their own stack.
+  Heads named in `stop` see detached features, so one evaluation serves
+  heads with and without gradients into the features.
+  '''
+
+  def __init__(self, heads):
+    super(ScalarHeads, self).__init__()
+    depths = collections.OrderedDict()
+    for name, head in heads.items():
+      assert head._shape == (1,), (name, head._shape)
+      assert head._std != 'learned', name
+      depths.setdefault(head._layers, []).append(name)
+    self._names = list(heads.keys())
+    self._groups = list(depths.values())
+    self._dists = {name: head._dist for name, head in heads.items()}
+    self._stds = {name: head._std for name, head in heads.items()}
+    first = next(iter(heads.values()))
+    self._act = first._act()
+    self.stacks = nn.ModuleList()
+    for names in self._groups:
+      stack = nn.Module()
+      linears = [
+          [m for m in heads[n]._mean_layers if isinstance(m, nn.Linear)]
+          for n in names]
+      stack.weights = nn.ParameterList([
+          nn.Parameter(torch.stack([l[i].weight.data.t() for l in linears]))
+          for i in range(len(linears[0]))])
+      stack.biases = nn.ParameterList([
+          nn.Parameter(torch.stack([l[i].bias.data for l in linears]))
+          for i in range(len(linears[0]))])
+      self.stacks.append(stack)
+    self._cache = None
+
+  @property
+  def names(self):
+    return list(self._names)
+
+  def _first(self, x, weight, bias, stop):
+    # x: [N, inp] -> [N, K, units], heads in stop get no gradient into x
+    count, inp, units = weight.shape
+    flat = lambda index: weight[index].permute(1, 0, 2).reshape(inp, -1)
+    if all(stop) or not any(stop):
+      inp_x = x.detach() if all(stop) else x
+      return torch.addmm(bias.reshape(-1), inp_x, flat(slice(None))).reshape(
+          x.shape[0], count, units)
+    live = [i for i, s in enumerate(stop) if not s]
+    held = [i for i, s in enumerate(stop) if s]
+    parts = [
+        torch.addmm(bias[index].reshape(-1), inp_x, flat(index)).reshape(
+            x.shape[0], len(index), units)
+        for index, inp_x in ((live, x), (held, x.detach()))]
+    inverse = torch.tensor(
+        [(live + held).index(i) for i in range(count)], device=x.device)
+    return torch.cat(parts, 1)[:, inverse]
+
+  def _stack(self, stack, x, stop):
+    # x: [N, inp] -> [K, N, out]
+    weight, bias = stack.weights[0], stack.biases[0]
+    if len(stack.weights) == 1:
+      return self._first(x, weight, bias, stop).transpose(0, 1)
+    x = self._act(self._first(x, weight, bias, stop)).transpose(0, 1)
+    for index in range(1, len(stack.weights)):
+      x = torch.baddbmm(
+          stack.biases[index][:, None], x, stack.weights[index])
+      if index < len(stack.weights) - 1:
+        x = self._act(x)
+    return x
+
+  def means(self, features, stop=()):
+    '''Returns {name: mean} for all heads, each shaped features[:-1] + (1,).'''
+    shape = features.shape[:-1]
+    x = features.reshape(-1, features.shape[-1])
+    means = {}
+    for names, stack in zip(self._groups, self.stacks):
+      out = self._stack(stack, x, [name in stop for name in names])
+      for index, name in enumerate(names):
+        means[name] = out[index].reshape(*shape, 1)
+    return means
+
+  def __call__(self, features, stop=()):
+    '''
+    Returns {name: dist} like calling each DenseHead. The result is memoized
+    for the last input so heads['reward'](feat), heads['cost'](feat), ...
+    share one evaluation; call clear() once the parameters change or the
+    graph of the features is no longer needed.
+    '''
+    key = (
+        features._version, frozenset(stop), torch.is_grad_enabled(),
+        torch.is_autocast_enabled(), torch.is_autocast_cpu_enabled())
+    if self._cache is not None:
+      last, last_key, dists = self._cache
+      if last is features and last_key == key:
+        return dists
+    means = self.means(features, stop)
+    dists = {
+        name: dense_dist(means[name], self._stds[name], self._dists[name], 1)
+        for name in self._names}
+    self._cache = (features, key, dists)
+    return dists
+
+  def clear(self):
+    self._cache = None
+
+  def fuse_state_dict(self, state_dict, heads_prefix, prefix):
+    '''Rewrites separate DenseHead entries of a checkpoint into this layout.'''
+    if heads_prefix + self._names[0] + '._mean_layers.0.weight' not in state_dict:
+      return state_dict
+    for group, names in enumerate(self._groups):
+      depth = len(self.stacks[group].weights)
+      for index in range(depth):
+        keys = [f'{heads_prefix}{n}._mean_layers.{2 * index}.' for n in names]
+        state_dict[f'{prefix}stacks.{group}.weights.{index}'] = torch.stack(
+            [state_dict.pop(k + 'weight').t() for k in keys])
+        state_dict[f'{prefix}stacks.{group}.biases.{index}'] = torch.stack(
+            [state_dict.pop(k + 'bias') for k in keys])
+    return state_dict
+
+  def split_state_dict(self, state_dict, heads_prefix, prefix):
+    '''Inverse of fuse_state_dict, for loading into separate DenseHeads.'''
+    for group, names in enumerate(self._groups):
+      depth = len(self.stacks[group].weights)
+      for index in range(depth):
+        weight = state_dict.pop(f'{prefix}stacks.{group}.weights.{index}')
+        bias = state_dict.pop(f'{prefix}stacks.{group}.biases.{index}')
+        for k, name in enumerate(names):
+          key = f'{heads_prefix}{name}._mean_layers.{2 * index}.'
+          state_dict[key + 'weight'] = weight[k].t().contiguous()
+          state_dict[key + 'bias'] = bias[k].clone()
+    return state_dict
+
+
+class FusedHead(nn.Module):
+  '''Stands in for one DenseHead in a heads dict, backed by ScalarHeads.'''
+
+  def __init__(self, fused, name):
+    super(FusedHead, self).__init__()
+    # kept out of the module tree so the weights are owned by one parent only
+    self._fused = (fused,)
+    self._name = name
+
+  def __call__(self, features, dtype=None):
+    return self._fused[0](features)[self._name]
+
+
+def fuse_scalar_heads(heads, names):
+  '''
+  Replaces heads[name] for the given names with FusedHead views over one
+  ScalarHeads initialised from their current weights, and returns it. The
+  caller owns the returned module and should register its
+  fuse_state_dict as a load hook so old checkpoints keep loading.
+  '''
+  names = [name for name in names if name in heads]
+  fused = ScalarHeads(collections.OrderedDict((n, heads[n]) for n in names))
+  for name in names:
+    heads[name] = FusedHead(fused, name)
+  return fused
 
 
 class ActionHead(nn.Module):
@@ -455,16 +742,59 @@ class ActionHead(nn.Module):
     return dist
 
 
+@torch.jit.script
+def _gru_gates_forward(parts, state, update_bias: float):
+  reset, cand, update = parts.chunk(3, -1)
+  reset = torch.sigmoid(reset)
+  cand = torch.tanh(reset * cand)
+  update = torch.sigmoid(update + update_bias)
+  output = state + update * (cand - state)
+  return output, reset, cand, update
+
+
+@torch.jit.script
+def _gru_gates_backward(grad, parts, state, reset, cand, update):
+  raw_cand = parts.chunk(3, -1)[1]
+  grad_update = grad * (cand - state) * update * (1 - update)
+  grad_pre_cand = grad * update * (1 - cand * cand)
+  grad_reset = grad_pre_cand * raw_cand * reset * (1 - reset)
+  grad_parts = torch.cat([grad_reset, grad_pre_cand * reset, grad_update], -1)
+  return grad_parts, grad * (1 - update)
+
+
+class GRUGates(torch.autograd.Function):
+  '''
+  Post-linear math of GRUCell (gates, candidate and blend) as one scripted
+  forward and one scripted backward, so the elementwise ops can be fused.
+  '''
+
+  @staticmethod
+  def forward(ctx, parts, state, update_bias):
+    output, reset, cand, update = _gru_gates_forward(parts, state, float(update_bias))
+    ctx.save_for_backward(parts, state, reset, cand, update)
+    return output
+
+  @staticmethod
+  @torch.autograd.function.once_differentiable
+  def backward(ctx, grad):
+    parts, state, reset, cand, update = ctx.saved_tensors
+    grad_parts, grad_state = _gru_gates_backward(
+        grad, parts, state, reset, cand, update)
+    return grad_parts.to(parts.dtype), grad_state.to(state.dtype), None
+
+
 class GRUCell(nn.Module):
 
   def __init__(self, inp_size,
-               size, norm=False, act=torch.tanh, update_bias=-1):
+               size, norm=False, act=torch.tanh, update_bias=-1, fused=False):
     super(GRUCell, self).__init__()
     self._inp_size = inp_size
     self._size = size
     self._act = act
     self._norm = norm
     self._update_bias = update_bias
+    assert not fused or act is torch.tanh, 'the fused gates only implement tanh'
+    self._fused = fused
     self._layer = nn.Linear(inp_size+size, 3*size,
                             bias=norm is not None)
     if norm:
@@ -479,6 +809,9 @@ class GRUCell(nn.Module):
     parts = self._layer(torch.cat([inputs, state], -1))
     if self._norm:
       parts = self._norm(parts)
+    if self._fused:
+      output = GRUGates.apply(parts, state, self._update_bias)
+      return output, [output]
     reset, cand, update = torch.split(parts, [self._size]*3, -1)
     reset = torch.sigmoid(reset)
     cand = self._act(reset * cand)
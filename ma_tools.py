@@ -1,9 +1,15 @@
+import collections
+import concurrent.futures
 import datetime
+import inspect
 import io
 import json
+import os
 import pathlib
 import pickle
+import queue
 import re
+import threading
 import time
 import uuid
 import wandb
@@ -226,10 +232,15 @@ def simulate(agent, envs, steps=0, episodes=0, state=None):
     cost = [0]*len(envs)
   else:
     step, episode, done, length, obs, agent_state, reward, cost = state
+  # envs from ma_wrappers.Parallel are dispatched together, then collected
+  # one by one through their wrappers
+  parallel = getattr(envs[0], 'parallel', None)
   while (steps and step < steps) or (episodes and episode < episodes):
     # Reset envs if necessary.
     if done.any():
       indices = [index for index, d in enumerate(done) if d]
+      if parallel is not None:
+        parallel.reset_async(indices)
       results = [envs[i].reset() for i in indices]
       for index, result in zip(indices, results):
         obs[index] = result
@@ -246,6 +257,8 @@ def simulate(agent, envs, steps=0, episodes=0, state=None):
       action = np.array(action)
     assert len(action) == len(envs)
     # Step envs.
+    if parallel is not None:
+      parallel.step_async(action)
     results = [e.step(a) for e, a in zip(envs, action)]
     obs, reward, cost, done = zip(*[p[:4] for p in results])
     obs = list(obs)
@@ -260,24 +273,142 @@ def simulate(agent, envs, steps=0, episodes=0, state=None):
   return (step - steps, episode - episodes, done, length, obs, agent_state, reward, cost)
 
 
-def save_episodes(directory, episodes):
+def save_episodes(directory, episodes, codec='zlib'):
   directory = pathlib.Path(directory).expanduser()
   directory.mkdir(parents=True, exist_ok=True)
-  timestamp = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
   filenames = []
   for episode in episodes:
-    identifier = str(uuid.uuid4().hex)
-    length = len(episode['reward'])
-    filename = directory / f'{timestamp}-{identifier}-{length}.npz'
-    with io.BytesIO() as f1:
-      np.savez_compressed(f1, **episode)
-      f1.seek(0)
-      with filename.open('wb') as f2:
-        f2.write(f1.read())
+    filename = episode_filename(directory, episode)
+    write_episode(filename, episode, codec)
     filenames.append(filename)
   return filenames
 
 
+def episode_filename(directory, episode):
+  timestamp = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+  identifier = str(uuid.uuid4().hex)
+  length = len(episode['reward'])
+  return pathlib.Path(directory) / f'{timestamp}-{identifier}-{length}.npz'
+
+
+# magic numbers of the lz4 frame and zstd formats
+_LZ4_MAGIC = b'\x04\x22\x4d\x18'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def write_episode(filename, episode, codec='zlib'):
+  '''
+  Writes an episode as .npz, compressed with zlib inside the archive or
+  with lz4/zstd around it. The file appears under its name only once it
+  is complete: it is written next to it and renamed.
+  '''
+  with io.BytesIO() as f1:
+    if codec == 'zlib':
+      np.savez_compressed(f1, **episode)
+    else:
+      np.savez(f1, **episode)
+    data = f1.getvalue()
+  if codec == 'lz4':
+    import lz4.frame
+    data = lz4.frame.compress(data)
+  elif codec == 'zstd':
+    import zstandard
+    data = zstandard.ZstdCompressor().compress(data)
+  elif codec not in ('none', 'zlib'):
+    raise NotImplementedError(codec)
+  temp = filename.with_name(filename.name + '.tmp')
+  with temp.open('wb') as f2:
+    f2.write(data)
+  os.replace(temp, filename)
+  manifest(filename.parent).append(filename, episode)
+
+
+def read_episode(filename):
+  with pathlib.Path(filename).open('rb') as f:
+    data = f.read()
+  if data[:4] == _LZ4_MAGIC:
+    import lz4.frame
+    data = lz4.frame.decompress(data)
+  elif data[:4] == _ZSTD_MAGIC:
+    import zstandard
+    data = zstandard.ZstdDecompressor().decompress(data)
+  with np.load(io.BytesIO(data)) as episode:
+    return {k: episode[k] for k in episode.keys()}
+
+
+class EpisodeWriter:
+  '''
+  Writes episodes on a pool of background threads. write() picks the
+  filename and returns at once, the caller keeps using the episode dict.
+  At most `depth` episodes wait in the queue, beyond that write() blocks.
+  zlib, lz4 and zstd release the GIL while compressing.
+  '''
+
+  def __init__(self, codec='zlib', workers=1, depth=8):
+    if codec == 'lz4':
+      import lz4.frame
+    elif codec == 'zstd':
+      import zstandard
+    elif codec not in ('none', 'zlib'):
+      raise NotImplementedError(codec)
+    self._codec = codec
+    self._queue = queue.Queue(depth)
+    self._lock = threading.Lock()
+    self._latency = 0.0
+    self._written = 0
+    self._error = None
+    self._threads = [
+        threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+    for thread in self._threads:
+      thread.start()
+
+  def write(self, directory, episode):
+    if self._error:
+      raise self._error
+    directory = pathlib.Path(directory).expanduser()
+    directory.mkdir(parents=True, exist_ok=True)
+    filename = episode_filename(directory, episode)
+    self._queue.put((filename, episode, time.perf_counter()))
+    return filename
+
+  def metrics(self):
+    '''Queue depth now and average time from write() to rename since the last call.'''
+    with self._lock:
+      metrics = {
+          'writer_queue': self._queue.qsize(),
+          'writer_latency_ms': 1000 * self._latency / max(self._written, 1)}
+      self._latency, self._written = 0.0, 0
+    return metrics
+
+  def flush(self):
+    self._queue.join()
+    if self._error:
+      raise self._error
+
+  def close(self):
+    self.flush()
+    for _ in self._threads:
+      self._queue.put(None)
+    for thread in self._threads:
+      thread.join()
+
+  def _work(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        self._queue.task_done()
+        return
+      filename, episode, start = item
+      try:
+        write_episode(filename, episode, self._codec)
+      except Exception as e:
+        self._error = e
+      with self._lock:
+        self._latency += time.perf_counter() - start
+        self._written += 1
+      self._queue.task_done()
+
+
 def from_generator(generator, batch_size):
   while True:
     batch = []
@@ -294,9 +425,16 @@ def from_generator(generator, batch_size):
 def sample_episodes(episodes, length=None, balance=False, seed=0):
   random = np.random.RandomState(seed)
   while True:
-    episode = random.choice(list(episodes.values()))
-    if length:
+    store = isinstance(episodes, ReplayStore)
+    if store:
+      # only the window is read from the memory-mapped chunks
+      number = random.randint(0, len(episodes))
+      total = episodes.length(number)
+    else:
+      episode = random.choice(list(episodes.values()))
       total = len(next(iter(episode.values())))
+    index = 0
+    if length:
       available = total - length
       if available < 1:
         print(f'Skipped short episode of length {available}.')
@@ -305,40 +443,877 @@ def sample_episodes(episodes, length=None, balance=False, seed=0):
         index = min(random.randint(0, total), available)
       else:
         index = int(random.randint(0, available + 1))
+    if store:
+      episode = episodes.window(number, index, length or total)
+    elif length:
       episode = {k: v[index: index + length] for k, v in episode.items()}
     yield episode
 
-def load_episodes(directory, limit=None, reverse=True):
-  directory = pathlib.Path(directory).expanduser()
-  episodes = {}
-  total = 0
-  if reverse:
-    for filename in reversed(sorted(directory.glob('*.npz'))):
+class BatchSampler:
+  '''
+  Draws the windows of a whole [batch, length] batch with a handful of
+  NumPy calls instead of one generator step per row. The episode index is
+  only rebuilt when the episodes change. Batches are gathered into a small
+  pool of reusable buffers, so a yielded batch stays valid until `buffers`
+  further batches were drawn.
+  Like sample_episodes, an episode is picked uniformly first and then a
+  start inside it, with `balance` oversampling the episode ends.
+  '''
+
+  def __init__(self, episodes, batch_size, length, balance=False, seed=0, buffers=2):
+    self._episodes = episodes
+    self._batch_size = batch_size
+    self._length = length
+    self._balance = balance
+    self._random = np.random.RandomState(seed)
+    self._steps = np.arange(length)
+    self._buffers = [None] * buffers
+    self._next = 0
+    self._version = None
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if isinstance(self._episodes, ReplayStore):
+      # the index must not go stale while the window is read
+      with self._episodes.lock:
+        return self._draw()
+    return self._draw()
+
+  def _draw(self):
+    self._refresh()
+    rows = self._random.randint(0, len(self._totals), self._batch_size)
+    totals = self._totals[rows]
+    available = totals - self._length
+    uniform = self._random.random_sample(self._batch_size)
+    if self._balance:
+      index = np.minimum((uniform * totals).astype(np.int64), available)
+    else:
+      index = (uniform * (available + 1)).astype(np.int64)
+    batch = self._buffer()
+    if isinstance(self._episodes, ReplayStore):
+      positions = (self._starts[rows] + index)[:, None] + self._steps
+      for key, value in batch.items():
+        self._episodes.read(key, positions, out=value)
+    else:
+      for key, value in batch.items():
+        for i, (row, start) in enumerate(zip(rows, index)):
+          value[i] = self._values[row][key][start: start + self._length]
+    return batch
+
+  def _refresh(self):
+    if isinstance(self._episodes, ReplayStore):
+      version = self._episodes.version
+    else:
+      # every new episode is inserted last under a fresh file name
+      version = (len(self._episodes), next(reversed(self._episodes), None))
+    if version == self._version:
+      return
+    self._version = version
+    if isinstance(self._episodes, ReplayStore):
+      starts, totals = self._episodes.index()
+      self._specs = self._episodes.specs
+    else:
+      self._values = list(self._episodes.values())
+      totals = np.array([len(ep['reward']) for ep in self._values], np.int64)
+      starts = np.zeros_like(totals)
+      if self._values:
+        self._specs = {
+            k: (v.shape[1:], v.dtype) for k, v in self._values[0].items()}
+    valid = totals - self._length >= 1
+    if not valid.any():
+      raise ValueError(f'No episode is longer than {self._length} steps.')
+    if not valid.all():
+      print(f'Skipped {int((~valid).sum())} episodes shorter than {self._length + 1} steps.')
+    self._starts, self._totals = starts[valid], totals[valid]
+    if not isinstance(self._episodes, ReplayStore):
+      self._values = [v for v, ok in zip(self._values, valid) if ok]
+
+  def _buffer(self):
+    batch = self._buffers[self._next]
+    if batch is None or batch.keys() != self._specs.keys():
+      batch = {
+          k: np.empty((self._batch_size, self._length) + tuple(shape), dtype)
+          for k, (shape, dtype) in self._specs.items()}
+      self._buffers[self._next] = batch
+    self._next = (self._next + 1) % len(self._buffers)
+    return batch
+
+
+class StreamingDataset:
+  '''
+  Batches of [batch_size, length] windows from a directory of episode
+  files that never has to fit into memory:
+  - the files are visited in a new random order on every pass
+  - a reservoir holds at most `reservoir` steps of decoded episodes and
+    every batch swaps `swap` random ones out for the next files
+  - windows are drawn from the reservoir by a BatchSampler, so batches
+    look exactly like those of make_dataset
+  The next files are decoded ahead on `workers` threads.
+  '''
+
+  def __init__(
+      self, directory, batch_size, length, reservoir=100000, swap=1,
+      balance=False, seed=0, workers=1, buffers=2):
+    directory = pathlib.Path(directory).expanduser()
+    index = manifest(directory)
+    if index.exists:
+      filenames = [directory / entry['filename'] for entry in index.entries()]
+    else:
+      filenames = list(directory.glob('*.npz'))
+    # windows need episodes with more than `length` steps
+    self._filenames = [
+        f for f in sorted(filenames) if int(f.stem.split('-')[-1]) > length]
+    if not self._filenames:
+      raise ValueError(f'No episode in {directory} is longer than {length} steps.')
+    self._reservoir = reservoir
+    self._swap = swap
+    self._random = np.random.RandomState(seed)
+    self._order = []
+    self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+    self._pending = collections.deque()
+    self._ahead = 2 * workers
+    self._episodes = {}
+    self._lengths = {}
+    self._steps = 0
+    self._sampler = BatchSampler(
+        self._episodes, batch_size, length, balance, seed, buffers)
+    while self._steps < reservoir and len(self._episodes) < len(self._filenames):
+      self._add()
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    for _ in range(self._swap):
+      self._add()
+    return next(self._sampler)
+
+  def _add(self):
+    filename, episode = self._next_episode()
+    length = len(episode['reward'])
+    while self._episodes and self._steps + length > self._reservoir:
+      keys = list(self._episodes.keys())
+      key = keys[self._random.randint(len(keys))]
+      del self._episodes[key]
+      self._steps -= self._lengths.pop(key)
+    # a file visited again in a later pass replaces its older copy
+    if str(filename) in self._episodes:
+      del self._episodes[str(filename)]
+      self._steps -= self._lengths.pop(str(filename))
+    self._episodes[str(filename)] = episode
+    self._lengths[str(filename)] = length
+    self._steps += length
+
+  def _next_episode(self):
+    while True:
+      while len(self._pending) < self._ahead:
+        if not self._order:
+          self._order = list(self._random.permutation(len(self._filenames)))
+        filename = self._filenames[self._order.pop()]
+        self._pending.append((filename, self._pool.submit(read_episode, filename)))
+      filename, future = self._pending.popleft()
       try:
-        with filename.open('rb') as f:
-          episode = np.load(f)
-          episode = {k: episode[k] for k in episode.keys()}
+        return filename, future.result()
       except Exception as e:
         print(f'Could not load episode: {e}')
-        continue
-      episodes[str(filename)] = episode
-      total += len(episode['reward']) - 1
+
+
+class Prefetcher:
+  '''
+  Builds the next `depth` batches of `dataset` on a background thread while
+  the model updates. `transform` turns a NumPy batch into CPU tensors
+  (reward and cost clipping, frames stay uint8 and are normalised by the
+  encoder on the device); on CUDA these are staged in pinned buffers and
+  copied on a side stream with non_blocking=True.
+  With depth 0 every batch is built when it is requested.
+  '''
+
+  def __init__(self, dataset, transform, device, depth=2):
+    self._dataset = dataset
+    self._transform = transform
+    self._device = torch.device(device)
+    self._depth = int(depth)
+    self._cuda = self._device.type == 'cuda'
+    self._stream = torch.cuda.Stream(self._device) if self._cuda else None
+    # a pinned buffer is reused once the copy out of it has finished
+    self._slots = [None] * (self._depth + 1)
+    self._slot = 0
+    self._stall = 0.0
+    self._level = 0
+    self._count = 0
+    self._error = None
+    if self._depth:
+      self._queue = queue.Queue(self._depth)
+      self._thread = threading.Thread(target=self._work, daemon=True)
+      self._thread.start()
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    # the worker stops at its first error, which is raised on every call
+    if self._error is not None:
+      raise self._error
+    start = time.perf_counter()
+    if self._depth:
+      self._level += self._queue.qsize()
+      batch, event = self._queue.get()
+      if isinstance(batch, Exception):
+        self._error = batch
+        raise batch
+    else:
+      batch, event = self._build()
+    self._stall += time.perf_counter() - start
+    self._count += 1
+    if event is not None:
+      stream = torch.cuda.current_stream(self._device)
+      stream.wait_event(event)
+      for value in batch.values():
+        value.record_stream(stream)
+    return batch
+
+  def metrics(self):
+    '''Average wait for a batch and queue fill since the last call.'''
+    count = max(self._count, 1)
+    metrics = {
+        'prefetch_stall_ms': 1000 * self._stall / count,
+        'prefetch_queue': self._level / count}
+    self._stall, self._level, self._count = 0.0, 0, 0
+    return metrics
+
+  def _work(self):
+    while True:
+      try:
+        item = self._build()
+      except Exception as e:
+        self._queue.put((e, None))
+        return
+      self._queue.put(item)
+
+  def _build(self):
+    batch = self._transform(next(self._dataset))
+    if not self._cuda:
+      return {k: v.to(self._device) for k, v in batch.items()}, None
+    slot = self._slots[self._slot]
+    if slot is None or any(
+        slot[0][k].shape != v.shape for k, v in batch.items()):
+      pinned = {
+          k: torch.empty(v.shape, dtype=v.dtype).pin_memory()
+          for k, v in batch.items()}
+    else:
+      pinned, event = slot
+      event.synchronize()
+    with torch.cuda.stream(self._stream):
+      staged = {}
+      for key, value in batch.items():
+        pinned[key].copy_(value)
+        staged[key] = pinned[key].to(self._device, non_blocking=True)
+      event = torch.cuda.Event()
+      event.record(self._stream)
+    self._slots[self._slot] = (pinned, event)
+    self._slot = (self._slot + 1) % len(self._slots)
+    return staged, event
+
+
+class DeviceReplay:
+  '''
+  The most recent `capacity` transitions kept in preallocated tensors on the
+  training device, episodes back to back in a ring: images stay uint8, float
+  scalars per step are stored as float16, everything else keeps its dtype.
+  sample() draws a [batch_size, length] batch with torch indexing only, the
+  episode and start chosen like BatchSampler does. Adding an episode evicts
+  the oldest ones its steps overwrite.
+  '''
+
+  def __init__(self, capacity, batch_size, length, device, balance=False, seed=0):
+    self._capacity = int(capacity)
+    self._batch_size = batch_size
+    self._length = length
+    self._device = torch.device(device)
+    self._balance = balance
+    self._generator = torch.Generator(self._device)
+    self._generator.manual_seed(seed)
+    self._steps = torch.arange(length, device=self._device)
+    self._data = None
+    self._episodes = collections.deque()
+    self._head = 0
+    self._used = 0
+    self._index = None
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._episodes)
+
+  @property
+  def size(self):
+    return self._used
+
+  @property
+  def ready(self):
+    '''Whether some resident episode is long enough for a window.'''
+    with self.lock:
+      return self._refresh() is not None
+
+  def add(self, episode):
+    length = len(episode['reward'])
+    if length > self._capacity:
+      print(f'Episode of {length} steps does not fit the device replay.')
+      return
+    with self.lock:
+      if self._data is None:
+        self._data = {
+            k: torch.empty(
+                (self._capacity,) + v.shape[1:], dtype=self._dtype(v),
+                device=self._device)
+            for k, v in episode.items()}
+      missing = self._data.keys() - episode.keys()
+      if missing:
+        print(f'Skipped an episode without {sorted(missing)} for the device replay.')
+        return
+      while self._used + length > self._capacity:
+        self._used -= self._episodes.popleft()[1]
+      positions = torch.arange(
+          self._head, self._head + length, device=self._device) % self._capacity
+      for key, value in self._data.items():
+        value[positions] = torch.as_tensor(episode[key]).to(
+            self._device, value.dtype, non_blocking=True)
+      self._episodes.append((self._head, length))
+      self._head = (self._head + length) % self._capacity
+      self._used += length
+      self._index = None
+
+  def extend(self, episodes):
+    '''
+    Adds the newest episodes of a dict or a ReplayStore, in order, as many
+    as fit.
+    '''
+    if isinstance(episodes, ReplayStore):
+      with episodes.lock:
+        starts, totals = episodes.index()
+        count, total = 0, 0
+        while count < len(totals) and total + totals[-1 - count] <= self._capacity:
+          total += totals[-1 - count]
+          count += 1
+        loaded = [
+            {k: episodes.read(k, np.arange(start, start + length))
+             for k in episodes.specs}
+            for start, length in zip(starts[len(starts) - count:], totals[len(totals) - count:])]
+    else:
+      # a snapshot, load_episodes may still fill the dict in the background
+      # and the one C level copy is atomic under the GIL
+      items = sorted(list(episodes.items()), key=lambda x: x[0], reverse=True)
+      loaded, total = [], 0
+      for _, episode in items:
+        total += len(episode['reward'])
+        if total > self._capacity:
+          break
+        loaded.append(episode)
+      loaded.reverse()
+    for episode in loaded:
+      self.add(episode)
+
+  def sample(self):
+    with self.lock:
+      index = self._refresh()
+      if index is None:
+        raise ValueError(f'No resident episode is longer than {self._length} steps.')
+      starts, totals = index
+      rows = torch.randint(
+          len(totals), (self._batch_size,), device=self._device,
+          generator=self._generator)
+      totals = totals[rows]
+      available = totals - self._length
+      uniform = torch.rand(
+          self._batch_size, device=self._device, generator=self._generator)
+      if self._balance:
+        start = torch.minimum((uniform * totals).long(), available)
+      else:
+        start = (uniform * (available + 1)).long()
+      positions = ((starts[rows] + start)[:, None] + self._steps) % self._capacity
+      return {k: v[positions] for k, v in self._data.items()}
+
+  def _refresh(self):
+    if self._index is None:
+      valid = [(s, l) for s, l in self._episodes if l - self._length >= 1]
+      if valid:
+        starts, totals = torch.tensor(valid, device=self._device).unbind(-1)
+        self._index = (starts, totals)
+      else:
+        self._index = False
+    return self._index or None
+
+  @staticmethod
+  def _dtype(value):
+    if value.dtype == np.uint8:
+      return torch.uint8
+    if np.issubdtype(value.dtype, np.floating):
+      return torch.float16 if value.ndim == 1 else torch.float32
+    return torch.as_tensor(value[:1]).dtype
+
+
+class MixedReplay:
+  '''
+  Batches drawn from a DeviceReplay for a `ratio` share of the updates and
+  from the host `dataset` (a Prefetcher) for the rest, so that most batches
+  need no host to device copy. Device batches go through `transform` on the
+  device. The host tier is used until the device replay can fill a window.
+  '''
+
+  def __init__(self, recent, dataset, transform, ratio=0.5):
+    self._recent = recent
+    self._dataset = dataset
+    self._transform = transform
+    self._ratio = ratio
+    self._credit = 0.0
+    self._drawn = 0
+    self._count = 0
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    self._count += 1
+    self._credit += self._ratio
+    if self._credit >= 1 and self._recent.ready:
+      self._credit -= 1
+      self._drawn += 1
+      return self._transform(self._recent.sample())
+    self._credit = min(self._credit, 1.0)
+    return next(self._dataset)
+
+  def metrics(self):
+    metrics = self._dataset.metrics()
+    metrics['recent_batches'] = self._drawn / max(self._count, 1)
+    metrics['recent_size'] = self._recent.size
+    self._drawn, self._count = 0, 0
+    return metrics
+
+
+def load_episodes(directory, limit=None, reverse=True, workers=0, min_steps=0):
+  '''
+  Loads the episodes of a directory, the newest first with reverse, until
+  limit transitions. With workers the files are decoded on a thread pool
+  and with min_steps the call returns once that many transitions are in,
+  the rest keeps streaming into the returned dict in the background.
+  '''
+  directory = pathlib.Path(directory).expanduser()
+  index = manifest(directory)
+  if index.exists:
+    # the manifest spares listing a directory of many files
+    filenames = sorted(directory / entry['filename'] for entry in index.entries())
+  else:
+    filenames = sorted(directory.glob('*.npz'))
+  if reverse:
+    filenames = filenames[::-1]
+  episodes = {}
+  stats = dict(start=time.perf_counter(), episodes=0, bytes=0)
+  if not workers:
+    total = 0
+    for filename in filenames:
+      total += _load_into(episodes, stats, filename, _read_sized(filename))
       if limit and total >= limit:
         break
+    _report_load(directory, stats)
+    return episodes
+  # the lengths in the file names tell which files fit into the limit
+  total, count = 0, 0
+  for filename in filenames:
+    if limit and total >= limit:
+      break
+    total += int(filename.stem.split('-')[-1]) - 1
+    count += 1
+  filenames = filenames[:count]
+  pool = concurrent.futures.ThreadPoolExecutor(workers)
+  futures = [pool.submit(_read_sized, filename) for filename in filenames]
+  pool.shutdown(wait=False)
+  # episodes the replay evicted while they were still loading are dropped
+  order = {
+      entry['filename']: index.evicted + number
+      for number, entry in enumerate(index.entries())} if index.exists else {}
+  def collect(position, until):
+    total = 0
+    while position < len(futures) and (not until or total < until):
+      loaded = futures[position].result()
+      with index.cache_lock:
+        if order.get(filenames[position].name, index.evicted) >= index.evicted:
+          total += _load_into(episodes, stats, filenames[position], loaded)
+      futures[position] = None  # evicted episodes must not stay referenced
+      position += 1
+    return position
+  position = collect(0, min_steps)
+  if position < len(futures):
+    print(f'Loaded {min_steps} steps, loading the remaining episodes in the background.')
+    def finish():
+      collect(position, None)
+      _report_load(directory, stats)
+    threading.Thread(target=finish, daemon=True).start()
   else:
-    for filename in sorted(directory.glob('*.npz')):
+    _report_load(directory, stats)
+  return episodes
+
+
+def _read_sized(filename):
+  try:
+    return read_episode(filename), os.path.getsize(filename)
+  except Exception as e:
+    return e, 0
+
+
+def _load_into(episodes, stats, filename, loaded):
+  episode, size = loaded
+  if isinstance(episode, Exception):
+    print(f'Could not load episode: {episode}')
+    return 0
+  episodes[str(filename)] = episode
+  stats['episodes'] += 1
+  stats['bytes'] += size
+  return len(episode['reward']) - 1
+
+
+def _report_load(directory, stats):
+  duration = max(time.perf_counter() - stats['start'], 1e-6)
+  megabytes = stats['bytes'] / 2 ** 20
+  print(
+      f"Loaded {stats['episodes']} episodes ({megabytes:.1f} MB) from {directory} "
+      f"in {duration:.1f}s, {megabytes / duration:.1f} MB/s, "
+      f"{stats['episodes'] / duration:.1f} episodes/s.")
+
+
+class Manifest:
+  '''
+  Append-only index of the episodes in a directory, manifest.jsonl holds
+  one line per episode with filename, length, return, cost and timestamp.
+  - entries are appended once an episode file is complete
+  - a directory that already holds episodes without a manifest is left
+    alone until rebuild() indexes it, so the manifest is never partial
+  - entries before `evicted` are dropped from memory, only their step
+    count is kept for steps()
+  '''
+
+  def __init__(self, directory):
+    self._directory = pathlib.Path(directory).expanduser()
+    self._path = self._directory / 'manifest.jsonl'
+    self._lock = threading.Lock()
+    self._entries = []
+    self._offset = 0
+    self._legacy = None
+    # entries before this were dropped from the replay cache and from _entries
+    self._evicted = 0
+    self._evicted_steps = 0
+    # held while the replay cache of this directory is filled or evicted
+    self.cache_lock = threading.Lock()
+
+  @property
+  def exists(self):
+    return self._path.exists()
+
+  def append(self, filename, episode):
+    filename = pathlib.Path(filename)
+    entry = self._entry(filename, episode, time.time())
+    with self._lock:
+      if not self._path.exists():
+        if self._legacy is None:
+          others = (
+              f for f in self._directory.glob('*.npz') if f.name != filename.name)
+          self._legacy = next(others, None) is not None
+          if self._legacy:
+            print(f'No manifest in {self._directory}, run rebuild_manifest.py to create one.')
+        if self._legacy:
+          return
+      with self._path.open('a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+  @property
+  def evicted(self):
+    return self._evicted
+
+  @evicted.setter
+  def evicted(self, value):
+    with self._lock:
+      drop = value - self._evicted
+      if drop <= 0:
+        return
+      self._evicted_steps += sum(e['length'] - 1 for e in self._entries[:drop])
+      del self._entries[:drop]
+      self._evicted = value
+
+  def entries(self):
+    '''
+    The entries from `evicted` on in the order they were appended, reads
+    only new lines. Entry i of the result is number evicted + i.
+    '''
+    with self._lock:
+      self._read()
+      return list(self._entries)
+
+  def steps(self):
+    '''Transitions of every episode appended, the evicted ones included.'''
+    with self._lock:
+      self._read()
+      return self._evicted_steps + sum(e['length'] - 1 for e in self._entries)
+
+  def _read(self):
+    if not self._path.exists():
+      return
+    with self._path.open('r') as f:
+      f.seek(self._offset)
+      for line in f:
+        if not line.endswith('\n'):
+          break  # being appended right now
+        self._entries.append(json.loads(line))
+        self._offset += len(line.encode())
+
+  def rebuild(self):
+    '''Indexes every episode file of the directory into a new manifest.'''
+    temp = self._path.with_name(self._path.name + '.tmp')
+    count = 0
+    with temp.open('w') as f:
+      for filename in sorted(self._directory.glob('*.npz')):
+        try:
+          episode = read_episode(filename)
+        except Exception as e:
+          print(f'Could not load episode: {e}')
+          continue
+        entry = self._entry(filename, episode, filename.stat().st_mtime)
+        f.write(json.dumps(entry) + '\n')
+        count += 1
+    with self._lock:
+      os.replace(temp, self._path)
+      self._entries, self._offset, self._legacy = [], 0, None
+      self._evicted, self._evicted_steps = 0, 0
+    return count
+
+  def _entry(self, filename, episode, timestamp):
+    total = lambda key: float(episode[key].astype(np.float64).sum()) \
+        if key in episode else 0.0
+    return {
+        'filename': filename.name, 'length': len(episode['reward']),
+        'return': total('reward'), 'cost': total('cost'),
+        'timestamp': timestamp}
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def manifest(directory):
+  '''The shared Manifest of a directory.'''
+  directory = pathlib.Path(directory).expanduser()
+  with _manifests_lock:
+    key = str(directory.resolve())
+    if key not in _manifests:
+      _manifests[key] = Manifest(directory)
+    return _manifests[key]
+
+
+class ReplayStore:
+  '''
+  Ring buffer of transitions kept on disk as uncompressed memory-mapped
+  chunks, one .npy file per key and chunk. Episodes are written back to back
+  and the oldest ones are dropped once the ring wraps onto them.
+  - meta.json holds capacity, chunk size and the shape/dtype of every key
+  - index.jsonl is an append-only log of [name, start, length] per episode
+  '''
+
+  def __init__(self, directory, capacity, chunk=10000):
+    # yaml reads numbers like 2e6 as strings
+    capacity, chunk = int(float(capacity)), int(float(chunk))
+    self._directory = pathlib.Path(directory).expanduser()
+    self._directory.mkdir(parents=True, exist_ok=True)
+    meta = self._directory / 'meta.json'
+    self._specs = None
+    if meta.exists():
+      meta = json.loads(meta.read_text())
+      if (meta['capacity'], meta['chunk']) != (int(capacity), int(chunk)):
+        print(f'Replay store keeps its capacity {meta["capacity"]} and chunk {meta["chunk"]}.')
+      capacity, chunk = meta['capacity'], meta['chunk']
+      self._specs = {
+          k: (tuple(shape), np.dtype(dtype)) for k, (shape, dtype) in meta['specs'].items()}
+    self._chunk = int(chunk)
+    # round up so the ring ends on a chunk boundary
+    self._capacity = -(-int(capacity) // self._chunk) * self._chunk
+    self._arrays = {}
+    self._names, self._starts, self._lengths = [], [], []
+    self._first = 0
+    self._size = 0
+    self._head = 0
+    self._records = 0
+    self._version = 0
+    # the prefetch thread reads while episodes are added
+    self.lock = threading.Lock()
+    self._load_index()
+
+  @property
+  def capacity(self):
+    return self._capacity
+
+  @property
+  def size(self):
+    return self._size
+
+  @property
+  def version(self):
+    return self._version
+
+  @property
+  def specs(self):
+    return self._specs
+
+  def __len__(self):
+    return len(self._names) - self._first
+
+  def __setitem__(self, name, episode):
+    self.add(name, episode)
+
+  def length(self, number):
+    return self._lengths[self._first + number]
+
+  def index(self):
+    '''Ring offsets and lengths of the episodes, oldest first.'''
+    return (np.asarray(self._starts[self._first:], np.int64),
+            np.asarray(self._lengths[self._first:], np.int64))
+
+  def add(self, name, episode):
+    with self.lock:
+      self._add(name, episode)
+
+  def _add(self, name, episode):
+    length = len(episode['reward'])
+    if length > self._capacity:
+      raise ValueError(f'Episode of length {length} exceeds the replay capacity {self._capacity}.')
+    if self._specs is None:
+      self._create(episode)
+    # evict from the front of the ring until the new episode fits
+    while self._size + length > self._capacity:
+      self._size -= self._lengths[self._first]
+      self._first += 1
+    positions = np.arange(self._head, self._head + length)
+    for key, (shape, dtype) in self._specs.items():
+      self._write(key, positions, np.asarray(episode[key], dtype))
+    for arrays in self._arrays.values():
+      for array in arrays.values():
+        array.flush()
+    self._append(str(name), self._head, length)
+    self._head = (self._head + length) % self._capacity
+    self._version += 1
+    if self._first > len(self._names) // 2:
+      self._compact()
+
+  def window(self, number, index, length):
+    with self.lock:
+      start = self._starts[self._first + number] + index
+      positions = np.arange(start, start + length)
+      return {key: self.read(key, positions) for key in self._specs}
+
+  def read(self, key, positions, out=None):
+    shape, dtype = self._specs[key]
+    positions = np.asarray(positions) % self._capacity
+    chunks, offsets = np.divmod(positions, self._chunk)
+    if out is None:
+      out = np.empty(positions.shape + shape, dtype)
+    for chunk in np.unique(chunks):
+      mask = chunks == chunk
+      out[mask] = self._array(key, chunk)[offsets[mask]]
+    return out
+
+  def extend(self, directory):
+    '''
+    Imports the newest .npz episodes of a directory that fit into the ring,
+    one file at a time.
+    '''
+    filenames = sorted(pathlib.Path(directory).expanduser().glob('*.npz'))
+    total, first = 0, len(filenames)
+    for index in reversed(range(len(filenames))):
+      total += int(filenames[index].stem.split('-')[-1])
+      if total > self._capacity:
+        break
+      first = index
+    for filename in filenames[first:]:
       try:
-        with filename.open('rb') as f:
-          episode = np.load(f)
-          episode = {k: episode[k] for k in episode.keys()}
+        episode = read_episode(filename)
       except Exception as e:
         print(f'Could not load episode: {e}')
         continue
-      episodes[str(filename)] = episode
-      total += len(episode['reward']) - 1
-      if limit and total >= limit:
+      self.add(str(filename), episode)
+
+  def _write(self, key, positions, value):
+    positions = positions % self._capacity
+    chunks, offsets = np.divmod(positions, self._chunk)
+    for chunk in np.unique(chunks):
+      mask = chunks == chunk
+      self._array(key, chunk)[offsets[mask]] = value[mask]
+
+  def _array(self, key, chunk):
+    arrays = self._arrays.setdefault(key, {})
+    if chunk not in arrays:
+      shape, dtype = self._specs[key]
+      filename = self._directory / f'{key}-{int(chunk):05d}.npy'
+      if filename.exists():
+        arrays[chunk] = np.load(filename, mmap_mode='r+')
+      else:
+        arrays[chunk] = np.lib.format.open_memmap(
+            filename, mode='w+', dtype=dtype, shape=(self._chunk,) + shape)
+    return arrays[chunk]
+
+  def _create(self, episode):
+    self._specs = {}
+    for key, value in episode.items():
+      value = np.asarray(value)
+      self._specs[key] = (value.shape[1:], value.dtype)
+    meta = dict(
+        capacity=self._capacity, chunk=self._chunk,
+        specs={k: [list(shape), dtype.str] for k, (shape, dtype) in self._specs.items()})
+    self._replace(self._directory / 'meta.json', json.dumps(meta))
+
+  def _load_index(self):
+    filename = self._directory / 'index.jsonl'
+    if not filename.exists():
+      return
+    records = [json.loads(line) for line in filename.read_text().splitlines() if line]
+    self._records = len(records)
+    if not records:
+      return
+    name, start, length = records[-1]
+    self._head = (start + length) % self._capacity
+    # newer episodes overwrote everything beyond the most recent capacity steps
+    total, first = 0, len(records)
+    for index in reversed(range(len(records))):
+      total += records[index][2]
+      if total > self._capacity:
         break
-  return episodes
+      first = index
+    for name, start, length in records[first:]:
+      self._names.append(name)
+      self._starts.append(start)
+      self._lengths.append(length)
+      self._size += length
+
+  def _append(self, name, start, length):
+    self._names.append(name)
+    self._starts.append(start)
+    self._lengths.append(length)
+    self._size += length
+    with (self._directory / 'index.jsonl').open('a') as f:
+      f.write(json.dumps([name, start, length]) + '\n')
+    self._records += 1
+
+  def _compact(self):
+    self._names = self._names[self._first:]
+    self._starts = self._starts[self._first:]
+    self._lengths = self._lengths[self._first:]
+    self._first = 0
+    if self._records > 2 * len(self._names):
+      lines = [json.dumps(list(record)) + '\n' for record in zip(
+          self._names, self._starts, self._lengths)]
+      self._replace(self._directory / 'index.jsonl', ''.join(lines))
+      self._records = len(lines)
+
+  def _replace(self, filename, text):
+    temp = filename.with_suffix(filename.suffix + '.tmp')
+    temp.write_text(text)
+    os.replace(temp, filename)
 
 
 class SampleDist:
@@ -530,6 +1505,63 @@ def static_scan_for_lambda_return(fn, inputs, start):
   return outputs
 
 
+def lambda_returns(reward, value, pcont, bootstrap, lambda_):
+  '''
+  Lambda-returns of K series at once: reward, value and pcont are
+  [H, B, K], bootstrap is [B, K], the result is [H, B, K] in time order.
+  R_t = r_t + p_t ((1 - lambda) v_{t+1} + lambda R_{t+1}) is solved in
+  closed form as a weighted sum with a [H, H + 1] matrix of discount
+  products instead of a loop over the horizon.
+  '''
+  return _lambda_returns_fn(reward, value, pcont, bootstrap, float(lambda_))
+
+
+def _lambda_returns(reward, value, pcont, bootstrap, lambda_: float):
+  horizon = reward.shape[0]
+  next_values = torch.cat([value[1:], bootstrap[None]], 0)
+  inputs = reward + pcont * next_values * (1 - lambda_)
+  shape = [horizon, horizon] + [1] * (reward.dim() - 1)
+  # upper[t, k] marks the steps k >= t that contribute to R_t
+  upper = torch.ones(
+      [horizon, horizon], dtype=torch.bool, device=reward.device).triu().reshape(shape)
+  decay = torch.where(upper, (pcont * lambda_)[None], torch.ones_like(pcont)[None])
+  products = torch.cumprod(decay, 1)
+  # weight of step k in R_t is the product of the decays from t to k - 1
+  weights = torch.cat([torch.ones_like(products[:, :1]), products], 1)
+  mask = torch.cat([upper, torch.ones_like(upper[:, :1])], 1)
+  weights = weights * mask.to(weights.dtype)
+  values = torch.cat([inputs, bootstrap[None]], 0)
+  return (weights * values[None]).sum(1)
+
+
+_lambda_returns_fn = _lambda_returns
+
+
+def compile_lambda_returns(mode):
+  '''
+  Selects how lambda_returns runs: none, script (TorchScript) or compile
+  (torch.compile, needs torch 2).
+  '''
+  global _lambda_returns_fn
+  if mode == 'none':
+    _lambda_returns_fn = _lambda_returns
+  elif mode == 'script':
+    _lambda_returns_fn = torch.jit.script(_lambda_returns)
+  elif mode == 'compile':
+    _lambda_returns_fn = torch.compile(_lambda_returns, dynamic=False)
+  else:
+    raise NotImplementedError(mode)
+
+
+def scan_layout(returns):
+  '''
+  Converts [H, B, 1] returns to the layout static_scan_for_lambda_return
+  produced and the behavior losses stack with torch.stack(target, dim=1):
+  one [H, 1] tensor per batch row, ordered from the last step to the first.
+  '''
+  return torch.unbind(returns.flip(0).transpose(0, 1), 0)
+
+
 def lambda_return(
     reward, value, pcont, bootstrap, lambda_, axis):
   # Setting lambda=1 gives a discounted Monte Carlo return.
@@ -546,87 +1578,52 @@ def lambda_return(
     pcont = pcont.permute(dims)
   if bootstrap is None:
     bootstrap = torch.zeros_like(value[-1])
-  next_values = torch.cat([value[1:], bootstrap[None]], 0)
-  inputs = reward + pcont * next_values * (1 - lambda_)
-  #returns = static_scan(
-  #    lambda agg, cur0, cur1: cur0 + cur1 * lambda_ * agg,
-  #    (inputs, pcont), bootstrap, reverse=True)
-  # reimplement to optimize performance
-  returns = static_scan_for_lambda_return(
-      lambda agg, cur0, cur1: cur0 + cur1 * lambda_ * agg,
-      (inputs, pcont), bootstrap)
+  returns = lambda_returns(reward, value, pcont, bootstrap, lambda_)
   if axis != 0:
     returns = returns.permute(dims)
-  return returns
-
-
-
-# def lambda_return_cost(
-#     cost, value_cost, pcont, bootstrap, lambda_, axis, discount_value_cost = False):
-#   # Setting lambda=1 gives a discounted Monte Carlo return.
-#   # Setting lambda=0 gives a fixed 1-step return.
-#   #assert reward.shape.ndims == value.shape.ndims, (reward.shape, value.shape)
-#   assert len(cost.shape) == len(value_cost.shape), (cost.shape, value_cost.shape)
-#   if isinstance(pcont, (int, float)):
-#     pcont = pcont * torch.ones_like(cost)
-#   # pcont = pcont if discount_value_cost else  torch.ones_like(cost)  # if not discount value cost then we just use 1 
-#   dims = list(range(len(cost.shape)))
-#   dims = [axis] + dims[1:axis] + [0] + dims[axis + 1:]
-#   if axis != 0:
-#     cost = cost.permute(dims)
-#     value_cost = value_cost.permute(dims)
-#     pcont = pcont.permute(dims)
-#   if bootstrap is None:
-#     bootstrap = torch.zeros_like(value_cost[-1])
-#   next_values = torch.cat([value_cost[1:], bootstrap[None]], 0)
-#   inputs = cost + pcont * next_values * (1 - lambda_)
-#   #returns = static_scan(
-#   #    lambda agg, cur0, cur1: cur0 + cur1 * lambda_ * agg,
-#   #    (inputs, pcont), bootstrap, reverse=True)
-#   # reimplement to optimize performance
-#   returns = static_scan_for_lambda_return(
-#       lambda agg, cur0, cur1: cur0 + cur1 * lambda_ * agg,
-#       (inputs, pcont), bootstrap)
-#   if axis != 0:
-#     returns = returns.permute(dims)
-#   return returns
+  return scan_layout(returns)
+
 
 def lambda_return_cost(
    cost, value_cost, pcont, bootstrap, lambda_, axis):
-  # Setting lambda=1 gives a discounted Monte Carlo return.
-  # Setting lambda=0 gives a fixed 1-step return.
-  #assert reward.shape.ndims == value.shape.ndims, (reward.shape, value.shape)
-  assert len(cost.shape) == len(value_cost.shape), (cost.shape, value_cost.shape)
-  if isinstance(pcont, (int, float)):
-    pcont = pcont * torch.ones_like(cost)
-  dims = list(range(len(cost.shape)))
-  dims = [axis] + dims[1:axis] + [0] + dims[axis + 1:]
-  if axis != 0:
-    cost = cost.permute(dims)
-    value_cost = value_cost.permute(dims)
-    pcont = pcont.permute(dims)
-  if bootstrap is None:
-    bootstrap = torch.zeros_like(value_cost[-1])
-  next_values = torch.cat([value_cost[1:], bootstrap[None]], 0)
-  inputs = cost + pcont * next_values * (1 - lambda_)
-  #returns = static_scan(
-  #    lambda agg, cur0, cur1: cur0 + cur1 * lambda_ * agg,
-  #    (inputs, pcont), bootstrap, reverse=True)
-  # reimplement to optimize performance
-  returns = static_scan_for_lambda_return(
-      lambda agg, cur0, cur1: cur0 + cur1 * lambda_ * agg,
-      (inputs, pcont), bootstrap)
-  if axis != 0:
-    returns = returns.permute(dims)
-  return returns
+  # Same recursion as lambda_return, over the cost and its value.
+  return lambda_return(cost, value_cost, pcont, bootstrap, lambda_, axis)
+
 
 
+class Precision:
+  '''
+  Mixed precision for the device the model trains on. With precision 16
+  autocast() runs in `dtype` on that device: 'auto' picks bfloat16 on CPU,
+  where float16 autocast is not supported, and float16 on CUDA. Only float16
+  on CUDA needs loss scaling, every other setting gets a disabled GradScaler
+  that passes the loss and the step straight through.
+  '''
+
+  def __init__(self, precision, device, dtype='auto'):
+    self.device_type = torch.device(device).type
+    if dtype == 'auto':
+      dtype = 'float16' if self.device_type == 'cuda' else 'bfloat16'
+    self.dtype = getattr(torch, dtype)
+    self.enabled = precision == 16
+    if self.enabled and self.device_type == 'cuda' and self.dtype == torch.bfloat16:
+      assert torch.cuda.is_bf16_supported(), 'bfloat16 is not supported by this gpu'
+    if self.enabled and self.device_type == 'cpu':
+      assert self.dtype == torch.bfloat16, 'autocast on cpu needs bfloat16'
+    self.scaled = self.enabled and self.device_type == 'cuda' and self.dtype == torch.float16
+
+  def autocast(self):
+    return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+  def scaler(self):
+    return torch.cuda.amp.GradScaler(enabled=self.scaled)
+
 
 class Optimizer():
 
   def __init__(
       self, name, parameters, lr, eps=1e-4, clip=None, wd=None, wd_pattern=r'.*',
-      opt='adam', use_amp=False):
+      opt='adam', use_amp=False, precision=None):
     assert 0 <= wd < 1
     assert not clip or 1 <= clip
     self._name = name
@@ -649,12 +1646,15 @@ class Optimizer():
                                 lr=lr,
                                 momentum=0.9),
     }[opt]()
-    self._scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+    # a Precision decides the scaler, use_amp alone means float16 on cuda
+    self._scaler = precision.scaler() if precision else \
+        torch.cuda.amp.GradScaler(enabled=use_amp)
 
   def __call__(self, loss, params, retain_graph=False):
     assert len(loss.shape) == 0, loss.shape
     metrics = {}
-    metrics[f'{self._name}_loss'] = loss.detach().cpu().numpy()
+    # stays on the device until Metrics reduces it at the log interval
+    metrics[f'{self._name}_loss'] = loss.detach()
     self._scaler.scale(loss).backward()
     self._scaler.unscale_(self._opt)
     #loss.backward(retain_graph=retain_graph)
@@ -665,7 +1665,82 @@ class Optimizer():
     self._scaler.update()
     #self._opt.step()
     self._opt.zero_grad()
-    metrics[f'{self._name}_grad_norm'] = norm.item()
+    metrics[f'{self._name}_grad_norm'] = norm.detach()
+    return metrics
+
+  def _apply_weight_decay(self, varibs):
+    nontrivial = (self._wd_pattern != r'.*')
+    if nontrivial:
+       raise NotImplementedError
+    for var in varibs:
+      var.data = (1 - self._wd) * var.data
+
+
+class GroupedOptimizer():
+  '''
+  One optimizer step for several losses over disjoint parameter groups.
+  The losses are summed for a single backward, then each group is clipped
+  with its own norm and updated with its own learning rate. Metrics stay
+  on the device until the logger reads them.
+  With float16 loss scaling all groups share one GradScaler: an inf or nan
+  gradient in any group skips the step of every group, where separate
+  Optimizers would only skip the head that overflowed.
+  groups: list of dicts with name, parameters, lr and clip.
+  '''
+
+  def __init__(
+      self, name, groups, eps=1e-4, wd=None, wd_pattern=r'.*', opt='adam',
+      use_amp=False, precision=None):
+    assert 0 <= wd < 1
+    assert all(not group['clip'] or 1 <= group['clip'] for group in groups)
+    self._name = name
+    self._groups = [dict(group, parameters=list(group['parameters'])) for group in groups]
+    self._wd = wd
+    self._wd_pattern = wd_pattern
+    param_groups = [
+        {'params': group['parameters'], 'lr': group['lr']} for group in self._groups]
+    parameters = [p for group in self._groups for p in group['parameters']]
+    kw = {}
+    if opt in ('adam', 'adamax'):
+      optimizer = torch.optim.Adam if opt == 'adam' else torch.optim.Adamax
+      options = inspect.signature(optimizer).parameters
+      # fused kernels need every parameter on the gpu
+      if 'fused' in options and all(p.is_cuda for p in parameters) and opt == 'adam':
+        kw['fused'] = True
+      elif 'foreach' in options:
+        kw['foreach'] = True
+    self._opt = {
+        'adam': lambda: torch.optim.Adam(param_groups, eps=eps, **kw),
+        'adamax': lambda: torch.optim.Adamax(param_groups, eps=eps, **kw),
+        'sgd': lambda: torch.optim.SGD(param_groups, lr=groups[0]['lr']),
+        'momentum': lambda: torch.optim.SGD(
+            param_groups, lr=groups[0]['lr'], momentum=0.9),
+    }[opt]()
+    # a Precision decides the scaler, use_amp alone means float16 on cuda
+    self._scaler = precision.scaler() if precision else \
+        torch.cuda.amp.GradScaler(enabled=use_amp)
+
+  def __call__(self, losses, retain_graph=False):
+    '''
+    losses: dict from group name to scalar loss, groups without a loss
+    keep their gradients at zero.
+    '''
+    metrics = {}
+    for name, loss in losses.items():
+      assert len(loss.shape) == 0, loss.shape
+      metrics[f'{name}_loss'] = loss.detach()
+    self._scaler.scale(sum(losses.values())).backward(retain_graph=retain_graph)
+    self._scaler.unscale_(self._opt)
+    for group in self._groups:
+      if group['name'] not in losses:
+        continue
+      norm = torch.nn.utils.clip_grad_norm_(group['parameters'], group['clip'])
+      metrics[f"{group['name']}_grad_norm"] = norm.detach()
+      if self._wd:
+        self._apply_weight_decay(group['parameters'])
+    self._scaler.step(self._opt)
+    self._scaler.update()
+    self._opt.zero_grad(set_to_none=True)
     return metrics
 
   def _apply_weight_decay(self, varibs):
@@ -695,37 +1770,24 @@ def args_type(default):
 
 
 def static_scan(fn, inputs, start):
+  # keeps every step and stacks once at the end, growing the outputs with
+  # torch.cat copied all previous steps again at every step
   last = start
+  steps = []
   indices = range(inputs[0].shape[0])
-  flag = True
   for index in indices:
     inp = lambda x: (_input[x] for _input in inputs)
     last = fn(last, *inp(index))
-    if flag:
-      if type(last) == type({}):
-        outputs = {key: value.clone().unsqueeze(0) for key, value in last.items()}
-      else:
-        outputs = []
-        for _last in last:
-          if type(_last) == type({}):
-            outputs.append({key: value.clone().unsqueeze(0) for key, value in _last.items()})
-          else:
-            outputs.append(_last.clone().unsqueeze(0))
-      flag = False
-    else:
-      if type(last) == type({}):
-        for key in last.keys():
-          outputs[key] = torch.cat([outputs[key], last[key].unsqueeze(0)], dim=0)
-      else:
-        for j in range(len(outputs)):
-          if type(last[j]) == type({}):
-            for key in last[j].keys():
-              outputs[j][key] = torch.cat([outputs[j][key],
-                  last[j][key].unsqueeze(0)], dim=0)
-          else:
-            outputs[j] = torch.cat([outputs[j], last[j].unsqueeze(0)], dim=0)
+    steps.append(last)
   if type(last) == type({}):
-    outputs = [outputs]
+    return [{key: torch.stack([step[key] for step in steps], 0) for key in last.keys()}]
+  outputs = []
+  for j in range(len(last)):
+    if type(last[j]) == type({}):
+      outputs.append({key: torch.stack([step[j][key] for step in steps], 0)
+                      for key in last[j].keys()})
+    else:
+      outputs.append(torch.stack([step[j] for step in steps], 0))
   return outputs
 
 
@@ -760,6 +1822,64 @@ def static_scan(fn, inputs, start):
 #  return res
 
 
+class Metrics:
+  '''
+  Accumulates training metrics per name without leaving the device: a
+  running sum, sum of squares, min and max as tensors and the count on
+  the host. result() moves all names to the host with one copy per
+  device and reduces them with any of mean, std, min and max.
+  '''
+
+  def __init__(self, reductions=('mean',)):
+    assert all(r in ('mean', 'std', 'min', 'max') for r in reductions), reductions
+    self._reductions = tuple(reductions)
+    self._stats = {}
+    self._counts = {}
+
+  def add(self, name, value):
+    if not torch.is_tensor(value):
+      value = torch.as_tensor(np.asarray(value, dtype=np.float32))
+    value = value.detach().float().reshape(-1)
+    stats = torch.stack([
+        value.sum(), (value * value).sum(), value.min(), value.max()])
+    if name in self._stats:
+      old = self._stats[name]
+      stats = torch.stack([
+          old[0] + stats[0], old[1] + stats[1],
+          torch.minimum(old[2], stats[2]), torch.maximum(old[3], stats[3])])
+    self._stats[name] = stats
+    self._counts[name] = self._counts.get(name, 0) + value.numel()
+
+  def update(self, metrics):
+    for name, value in metrics.items():
+      self.add(name, value)
+
+  def result(self, reset=True):
+    devices = {}
+    for name, stats in self._stats.items():
+      devices.setdefault(stats.device, []).append(name)
+    result = {}
+    for names in devices.values():
+      # the single sync for all names on this device
+      stats = torch.stack([self._stats[name] for name in names]).cpu().numpy()
+      for name, (total, squares, low, high) in zip(names, stats):
+        count = self._counts[name]
+        mean = total / count
+        values = dict(
+            mean=mean, std=np.sqrt(max(squares / count - mean ** 2, 0.0)),
+            min=low, max=high)
+        for reduction in self._reductions:
+          key = name if reduction == 'mean' else f'{name}_{reduction}'
+          result[key] = float(values[reduction])
+    if reset:
+      self.reset()
+    return result
+
+  def reset(self):
+    self._stats = {}
+    self._counts = {}
+
+
 class Every:
 
   def __init__(self, every):
@@ -1,3 +1,8 @@
+import collections
+import multiprocessing
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+
 import numpy as np
 import gym
 import safety_gymnasium
@@ -347,3 +352,237 @@ class CostObs:
     obs['cost'] = 0.0
     return obs
 
+
+
+Shared = collections.namedtuple('Shared', 'name, shape, dtype')
+
+
+class Parallel:
+  '''
+  Runs every environment of a batch in its own subprocess so physics and
+  rendering of all envs overlap. Large arrays in observations (the image)
+  come back through one shared memory block per worker and key, everything
+  else through the pipe. `envs` are per index proxies that the main process
+  wraps further; a proxy step returns the result of the batched step sent
+  with step_async, or steps its worker on its own otherwise.
+  - strategy 'process' steps asynchronously in subprocesses
+  - strategy 'none' steps synchronously in this process, for debugging
+  '''
+
+  def __init__(self, constructors, strategy='process'):
+    self._strategy = strategy
+    self._pending = [None] * len(constructors)
+    self._memory = {}
+    if strategy == 'none':
+      self._envs = [constructor() for constructor in constructors]
+    elif strategy == 'process':
+      # spawn, forked children would inherit the CUDA and EGL state
+      context = multiprocessing.get_context('spawn')
+      self._conns, self._processes = [], []
+      for constructor in constructors:
+        conn, child = context.Pipe()
+        process = context.Process(
+            target=_parallel_worker, args=(constructor, child), daemon=True)
+        process.start()
+        child.close()
+        self._conns.append(conn)
+        self._processes.append(process)
+    else:
+      raise NotImplementedError(strategy)
+    self._closed = [False] * len(constructors)
+    self.envs = [Remote(self, index) for index in range(len(constructors))]
+
+  def __len__(self):
+    return len(self.envs)
+
+  def step_async(self, actions):
+    for index, action in enumerate(actions):
+      self._send(index, 'step', action)
+
+  def step_wait(self):
+    return [self.take(index) for index in range(len(self))]
+
+  def step(self, actions):
+    self.step_async(actions)
+    return self.step_wait()
+
+  def reset_async(self, indices=None):
+    indices = range(len(self)) if indices is None else indices
+    for index in indices:
+      self._send(index, 'reset', None)
+
+  def reset_wait(self, indices=None):
+    indices = range(len(self)) if indices is None else indices
+    return [self.take(index) for index in indices]
+
+  def reset(self, indices=None):
+    self.reset_async(indices)
+    return self.reset_wait(indices)
+
+  def call(self, index, method, payload):
+    if self._pending[index] is None:
+      self._send(index, method, payload)
+    return self.take(index)
+
+  def take(self, index):
+    method = self._pending[index]
+    assert method is not None, 'Nothing was sent to this environment.'
+    self._pending[index] = None
+    if self._strategy == 'none':
+      status, result = self._results[index]
+      if status != 'ok':
+        raise result
+      return result
+    status, result = self._conns[index].recv()
+    if status == 'missing':
+      raise AttributeError(result)
+    if status == 'error':
+      raise RuntimeError(f'Environment {index} failed:\n{result}')
+    if method == 'step':
+      obs, *rest = result
+      return (self._unshare(obs), *rest)
+    if method == 'reset':
+      return self._unshare(result)
+    return result
+
+  def close(self, index=None):
+    indices = range(len(self)) if index is None else [index]
+    for index in indices:
+      if self._closed[index]:
+        continue
+      self._closed[index] = True
+      if self._strategy == 'none':
+        self._envs[index].close()
+        continue
+      try:
+        self._conns[index].send(('close', None))
+        self._processes[index].join(5)
+      except (BrokenPipeError, EOFError):
+        pass
+      self._conns[index].close()
+    if all(self._closed):
+      for memory in self._memory.values():
+        memory.close()
+      self._memory = {}
+
+  def _send(self, index, method, payload):
+    assert self._pending[index] is None, 'Environment is still busy.'
+    self._pending[index] = method
+    if self._strategy == 'none':
+      if not hasattr(self, '_results'):
+        self._results = [None] * len(self)
+      env = self._envs[index]
+      # raised by take, like the errors of the subprocesses
+      try:
+        self._results[index] = ('ok', {
+            'step': lambda: env.step(payload),
+            'reset': lambda: env.reset(),
+            'attr': lambda: getattr(env, payload),
+        }[method]())
+      except Exception as e:
+        self._results[index] = ('error', e)
+    else:
+      self._conns[index].send((method, payload))
+
+  def _unshare(self, obs):
+    obs = dict(obs)
+    for key, value in obs.items():
+      if isinstance(value, Shared):
+        if value.name not in self._memory:
+          memory = shared_memory.SharedMemory(value.name)
+          # the worker owns the block and unlinks it
+          resource_tracker.unregister(memory._name, 'shared_memory')
+          self._memory[value.name] = memory
+        buffer = self._memory[value.name].buf
+        # copied because the worker overwrites the block on its next step
+        obs[key] = np.ndarray(value.shape, value.dtype, buffer=buffer).copy()
+    return obs
+
+
+class Remote:
+
+  def __init__(self, parallel, index):
+    self.parallel = parallel
+    self._index = index
+    self._spaces = {}
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return self.parallel.call(self._index, 'attr', name)
+
+  @property
+  def observation_space(self):
+    return self._space('observation_space')
+
+  @property
+  def action_space(self):
+    return self._space('action_space')
+
+  def step(self, action):
+    return self.parallel.call(self._index, 'step', action)
+
+  def reset(self):
+    return self.parallel.call(self._index, 'reset', None)
+
+  def close(self):
+    self.parallel.close(self._index)
+
+  def _space(self, name):
+    if name not in self._spaces:
+      self._spaces[name] = self.parallel.call(self._index, 'attr', name)
+    return self._spaces[name]
+
+
+def _parallel_worker(constructor, conn):
+  memory = {}
+  def share(obs):
+    obs = dict(obs)
+    for key, value in obs.items():
+      if isinstance(value, np.ndarray) and value.nbytes >= 1024:
+        if key not in memory or memory[key].size < value.nbytes:
+          if key in memory:
+            memory[key].close()
+            memory[key].unlink()
+          memory[key] = shared_memory.SharedMemory(create=True, size=value.nbytes)
+        np.ndarray(value.shape, value.dtype, buffer=memory[key].buf)[...] = value
+        obs[key] = Shared(memory[key].name, value.shape, value.dtype.str)
+    return obs
+  env = None
+  try:
+    env = constructor()
+    while True:
+      method, payload = conn.recv()
+      if method == 'close':
+        break
+      # a failed call is reported and the worker keeps serving
+      try:
+        if method == 'step':
+          obs, *rest = env.step(payload)
+          result = (share(obs), *rest)
+        elif method == 'reset':
+          result = share(env.reset())
+        elif method == 'attr':
+          result = getattr(env, payload)
+      except Exception as e:
+        if method == 'attr' and isinstance(e, AttributeError):
+          conn.send(('missing', str(e)))
+        else:
+          conn.send(('error', traceback.format_exc()))
+        continue
+      conn.send(('ok', result))
+  except (KeyboardInterrupt, EOFError):
+    pass
+  except Exception:
+    # the env could not be built
+    conn.send(('error', traceback.format_exc()))
+  finally:
+    if env is not None:
+      try:
+        env.close()
+      except Exception:
+        pass
+    for block in memory.values():
+      block.close()
+      block.unlink()
+    conn.close()
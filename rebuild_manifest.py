@@ -0,0 +1,16 @@
+import argparse
+import pathlib
+
+import ma_tools as tools
+
+# Indexes the episode files of replay directories into manifest.jsonl, for
+# directories written before the manifest existed. Usage:
+#   python rebuild_manifest.py logdir/safecircle1/0/train_eps logdir/safecircle1/0/eval_eps
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('directories', nargs='+', type=pathlib.Path)
+  args = parser.parse_args()
+  for directory in args.directories:
+    count = tools.manifest(directory).rebuild()
+    print(f'{directory}: indexed {count} episodes.')
@@ -0,0 +1,66 @@
+import argparse
+import pathlib
+import sys
+
+import ruamel.yaml as yaml
+import torch
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+import ma_models as models
+import ma_tools as tools
+
+# Runs real ImagBehavior._train steps of ma_models on CPU with small
+# networks, for the separate and the grouped optimizers and for fused
+# imagination, with and without the future entropy bonus. Every update
+# backpropagates through the imagined dynamics, so a graph shared between
+# two separately stepped losses fails here.
+
+
+def make_config(**overrides):
+  configs = yaml.safe_load(
+      (pathlib.Path(__file__).parent.parent / 'ma_configs.yaml').read_text())
+  values = {}
+  for name in ('defaults', 'sgym'):
+    values.update(configs[name])
+  values = {k: tools.args_type(v)(v) for k, v in values.items()}
+  values.update(
+      device='cpu', precision=32, num_actions=2, units=64, dyn_deter=64,
+      dyn_hidden=64, dyn_stoch=8, dyn_discrete=8, cnn_depth=8, imag_horizon=5)
+  values.update(overrides)
+  config = argparse.Namespace(**values)
+  config.act = getattr(torch.nn, config.act)
+  # the schedules Dreamer turns into closures
+  for key in ('actor_entropy', 'actor_state_entropy', 'imag_gradient_mix'):
+    setattr(config, key, lambda x=getattr(config, key): tools.schedule(x, 0))
+  return config
+
+
+def train_step(**overrides):
+  torch.manual_seed(0)
+  config = make_config(**overrides)
+  world_model = models.WorldModel(0, config)
+  behavior = models.ImagBehavior(config, world_model, config.behavior_stop_grad)
+  world_model.requires_grad_(False)
+  behavior.requires_grad_(False)
+  state = world_model.dynamics.initial(8)
+  start = {k: v[:, None].expand(8, 3, *v.shape[1:]) for k, v in state.items()}
+  reward = lambda f, s, a: world_model.heads['reward'](f).mode()
+  cost = lambda f, s, a: world_model.heads['cost'](f).mode()
+  for _ in range(2):
+    metrics = behavior._train(start, reward, cost, mean_ep_cost=0.0)[-1]
+  return metrics
+
+
+cases = [
+    dict(),
+    dict(grouped_behavior_opt=True),
+    dict(fused_imagination=True, grouped_behavior_opt=True),
+    dict(future_entropy=True, slow_value_target=True, slow_actor_target=False),
+    dict(fused_imagination=True, grouped_behavior_opt=True, future_entropy=True,
+         slow_value_target=True, slow_actor_target=False),
+]
+for overrides in cases:
+  metrics = train_step(**overrides)
+  loss = float(metrics['actor_loss'])
+  name = str(overrides) if overrides else 'defaults'
+  print(f'{name:100s} ok  actor_loss {loss:.4f}')
@@ -0,0 +1,58 @@
+import pathlib
+import sys
+import time
+
+import torch
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+import ma_networks as networks
+
+# Checks the fused GRU gates against the eager cell (outputs, gradients and
+# gradcheck in double) and times forward plus backward on CPU.
+
+
+def make_cell(fused, dtype=torch.float32):
+  torch.manual_seed(0)
+  return networks.GRUCell(200, 200, norm=True, fused=fused).to(dtype)
+
+
+def run(cell, inputs, state):
+  output, _ = cell(inputs, [state])
+  output.square().sum().backward()
+  return output
+
+
+torch.manual_seed(1)
+inputs = torch.randn(800, 200, requires_grad=True)
+state = torch.randn(800, 200, requires_grad=True)
+eager, fused = make_cell(False), make_cell(True)
+out_eager = run(eager, inputs, state)
+grads_eager = [inputs.grad.clone(), state.grad.clone()] + [
+    p.grad.clone() for p in eager.parameters()]
+inputs.grad, state.grad = None, None
+out_fused = run(fused, inputs, state)
+grads_fused = [inputs.grad, state.grad] + [p.grad for p in fused.parameters()]
+assert torch.allclose(out_eager, out_fused, atol=1e-6)
+for a, b in zip(grads_eager, grads_fused):
+  assert torch.allclose(a, b, atol=1e-4), (a - b).abs().max()
+print('outputs and gradients match')
+
+parts = torch.randn(4, 30, dtype=torch.double, requires_grad=True)
+small_state = torch.randn(4, 10, dtype=torch.double, requires_grad=True)
+assert torch.autograd.gradcheck(
+    lambda p, s: networks.GRUGates.apply(p, s, -1.0), (parts, small_state))
+print('gradcheck passed')
+
+for batch in (16, 800):
+  inputs = torch.randn(batch, 200, requires_grad=True)
+  state = torch.randn(batch, 200, requires_grad=True)
+  times = []
+  for cell in (eager, fused):
+    for _ in range(5):
+      run(cell, inputs, state)
+    start = time.perf_counter()
+    for _ in range(100):
+      run(cell, inputs, state)
+    times.append((time.perf_counter() - start) / 100)
+  print(f'batch {batch:4d}  eager {1e6 * times[0]:8.1f} us  '
+        f'fused {1e6 * times[1]:8.1f} us  speedup {times[0] / times[1]:.2f}x')
@@ -0,0 +1,52 @@
+import pathlib
+import sys
+import time
+
+import torch
+from torch import nn
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+import ma_networks as networks
+import ma_tools as tools
+
+# CPU throughput of a world model update (encoder, RSSM observe, reward head
+# and optimizer step) in float32 and with bfloat16 autocast via
+# tools.Precision.
+
+
+def update_step(precision, batch, length, repeats):
+  torch.manual_seed(0)
+  encoder = networks.ConvEncoder(depth=32, act=nn.ELU)
+  rssm = networks.RSSM(
+      stoch=32, deter=200, hidden=200, discrete=32, cell='gru_layer_norm',
+      num_actions=2, embed=32 * 8 * 2 * 2, device='cpu')
+  head = networks.DenseHead(32 * 32 + 200, [], 2, 400, nn.ELU)
+  modules = nn.ModuleList([encoder, rssm, head])
+  opt = tools.Optimizer(
+      'model', modules.parameters(), 3e-4, 1e-5, 100, 0.0, precision=precision)
+  data = {
+      'image': torch.randint(0, 256, (batch, length, 64, 64, 3), dtype=torch.uint8),
+      'action': torch.rand(batch, length, 2) * 2 - 1,
+      'reward': torch.randn(batch, length, 1)}
+
+  def step():
+    with precision.autocast():
+      embed = encoder(data)
+      post, _ = rssm.observe(embed, data['action'])
+      like = head(rssm.get_feat(post)).log_prob(data['reward'])
+      loss = -like.float().mean()
+    opt(loss, modules.parameters())
+
+  step()
+  start = time.perf_counter()
+  for _ in range(repeats):
+    step()
+  return (time.perf_counter() - start) / repeats
+
+
+batch, length = 16, 50
+for precision in (tools.Precision(32, 'cpu'), tools.Precision(16, 'cpu')):
+  name = str(precision.dtype).split('.')[-1] if precision.enabled else 'float32'
+  duration = update_step(precision, batch, length, 5)
+  print(f'{name:9s} {1000 * duration:8.1f} ms per update  '
+        f'{batch * length / duration:8.0f} steps/s  scaler {precision.scaled}')
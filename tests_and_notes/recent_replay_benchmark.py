@@ -0,0 +1,64 @@
+import pathlib
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+import ma_models_default as models
+import ma_tools as tools
+
+# Times batches of the host BatchSampler, normalised and copied to the
+# device, against batches drawn from the DeviceReplay on the device.
+
+
+def normalize(obs):
+  obs = obs.copy()
+  obs['image'] = models.to_float(obs['image']) / 255.0 - 0.5
+  obs['reward'] = torch.tanh(models.to_float(obs['reward'])).unsqueeze(-1)
+  obs['cost'] = models.to_float(obs['cost']).unsqueeze(-1)
+  obs['discount'] = (models.to_float(obs['discount']) * 0.99).unsqueeze(-1)
+  return {k: models.to_float(v) for k, v in obs.items()}
+
+
+def episode(length, rng):
+  return {
+      'image': rng.randint(0, 256, (length, 64, 64, 3), dtype=np.uint8),
+      'action': rng.uniform(-1, 1, (length, 2)).astype(np.float32),
+      'reward': rng.randn(length).astype(np.float32),
+      'cost': (rng.rand(length) < 0.1).astype(np.float32),
+      'discount': np.ones(length, np.float32)}
+
+
+def timed(draw, device, repeats):
+  draw()
+  if device.type == 'cuda':
+    torch.cuda.synchronize()
+  start = time.perf_counter()
+  for _ in range(repeats):
+    batch = draw()
+  if device.type == 'cuda':
+    torch.cuda.synchronize()
+  return (time.perf_counter() - start) / repeats, batch
+
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+rng = np.random.RandomState(0)
+episodes = {f'{i:06d}-501': episode(501, rng) for i in range(40)}
+batch_size, length = 16, 50
+
+sampler = tools.BatchSampler(episodes, batch_size, length)
+host = lambda: {k: v.to(device) for k, v in normalize(next(sampler)).items()}
+recent = tools.DeviceReplay(40 * 501, batch_size, length, device)
+recent.extend(episodes)
+resident = lambda: normalize(recent.sample())
+
+old, a = timed(host, device, 50)
+new, b = timed(resident, device, 50)
+assert a.keys() == b.keys()
+assert all(a[k].shape == b[k].shape and a[k].dtype == b[k].dtype for k in a)
+print(f'{device}  host {1000 * old:7.2f} ms  device {1000 * new:7.2f} ms  '
+      f'speedup {old / new:.2f}x')
+for key, value in recent._data.items():
+  print(f'{key:9s} {str(value.dtype):14s} {value.element_size() * value.nelement() / 2 ** 20:8.1f} MB')
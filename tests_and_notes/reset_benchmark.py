@@ -0,0 +1,52 @@
+import pathlib
+import sys
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+import ma_dreamer
+import ma_networks as networks
+
+# Per step latency of the agent's reset masking, the old per env loop
+# against ma_dreamer.mask_state, next to one policy step (obs_step and
+# actor) for scale, for 1 to 64 envs on CPU.
+
+
+def loop_mask(state, reset):
+  mask = 1 - reset
+  for key in state[0].keys():
+    for i in range(state[0][key].shape[0]):
+      state[0][key][i] *= mask[i]
+  for i in range(len(state[1])):
+    state[1][i] *= mask[i]
+
+
+def timed(fn, repeats=200):
+  fn()
+  start = time.perf_counter()
+  for _ in range(repeats):
+    fn()
+  return 1e6 * (time.perf_counter() - start) / repeats
+
+
+torch.manual_seed(0)
+rssm = networks.RSSM(
+    stoch=50, deter=200, hidden=200, act=nn.ELU, std_act='sigmoid2',
+    cell='gru_layer_norm', num_actions=2, embed=1024, device='cpu')
+actor = networks.ActionHead(250, 2, 4, 400, nn.ELU, init_std=1.0)
+for envs in (1, 2, 4, 8, 16, 32, 64):
+  latent, action = rssm.initial(envs), torch.zeros(envs, 2)
+  reset = np.arange(envs) % 2 == 0
+  embed = torch.randn(envs, 1024)
+  def step():
+    with torch.no_grad():
+      post, _ = rssm.obs_step(latent, action, embed)
+      actor(rssm.get_feat(post)).sample()
+  old = timed(lambda: loop_mask((latent, action), reset))
+  new = timed(lambda: ma_dreamer.mask_state((latent, action), reset))
+  policy = timed(step, 50)
+  print(f'envs {envs:3d}  loop {old:8.1f} us  broadcast {new:6.1f} us  '
+        f'policy step {policy:8.1f} us')
@@ -0,0 +1,48 @@
+import pathlib
+import sys
+import time
+import types
+
+import torch
+from torch import nn
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+import ma_dreamer
+import ma_networks as networks
+
+# Per step latency of Dreamer.get_safe_action on CPU for several numbers of
+# candidates, with untrained heads of the sgym sizes.
+
+
+def make_agent(num, cem_iters):
+  feat_size = 50 + 200
+  dynamics = networks.RSSM(
+      stoch=50, deter=200, hidden=200, act=nn.ELU, std_act='sigmoid2',
+      cell='gru_layer_norm', num_actions=2, embed=1024, device='cpu')
+  wm = types.SimpleNamespace(
+      dynamics=dynamics,
+      heads={'cost': networks.DenseHead(feat_size, [], 2, 400, nn.ELU)})
+  behavior = types.SimpleNamespace(
+      safe_actor=networks.ActionHead(feat_size, 2, 4, 400, nn.ELU, init_std=1.0),
+      value=networks.DenseHead(feat_size, [], 3, 400, nn.ELU))
+  config = types.SimpleNamespace(
+      num_sampled_action=num, safety_look_ahead_steps=15, imag_sample=True,
+      cost_threshold=3, safe_action_cem_iters=cem_iters, safe_action_elites=5,
+      actor_dist='trunc_normal')
+  agent = types.SimpleNamespace(_wm=wm, _task_behavior=behavior, _config=config)
+  agent._score_safe_actions = types.MethodType(
+      ma_dreamer.Dreamer._score_safe_actions, agent)
+  return agent, dynamics.initial(1)
+
+
+torch.manual_seed(0)
+for cem_iters in (0, 2):
+  for num in (20, 100, 500):
+    agent, latent = make_agent(num, cem_iters)
+    ma_dreamer.Dreamer.get_safe_action(agent, latent)
+    start = time.perf_counter()
+    for _ in range(10):
+      action = ma_dreamer.Dreamer.get_safe_action(agent, latent)
+    duration = (time.perf_counter() - start) / 10
+    assert action.shape == (1, 2), action.shape
+    print(f'candidates {num:4d}  cem iterations {cem_iters}  {1000 * duration:8.2f} ms per step')
@@ -0,0 +1,87 @@
+import collections
+import pathlib
+import sys
+import time
+
+import torch
+from torch import nn
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+import ma_networks as networks
+
+# Times the reward, cost and discount heads as three DenseHeads and as one
+# ScalarHeads on CPU, checks both give the same predictions and the same
+# feature gradients when some heads stop theirs, and round trips the weights
+# through the state-dict converter.
+
+
+def separate_heads(feat_size, units):
+  heads = collections.OrderedDict()
+  heads['reward'] = networks.DenseHead(feat_size, [], 2, units, nn.ELU)
+  heads['cost'] = networks.DenseHead(feat_size, [], 2, units, nn.ELU)
+  heads['discount'] = networks.DenseHead(
+      feat_size, [], 3, units, nn.ELU, dist='binary')
+  return heads
+
+
+def run_separate(heads, feat):
+  return [heads[name](feat).mean for name in heads]
+
+
+def run_fused(fused, feat):
+  fused.clear()
+  dists = fused(feat)
+  return [dists[name].mean for name in dists]
+
+
+def timed(fn, *args, repeats=20, grad=False):
+  fn(*args)
+  start = time.perf_counter()
+  for _ in range(repeats):
+    if grad:
+      sum(x.sum() for x in fn(*args)).backward()
+    else:
+      with torch.no_grad():
+        fn(*args)
+  return (time.perf_counter() - start) / repeats
+
+
+torch.manual_seed(0)
+feat_size, units = 230, 400
+heads = separate_heads(feat_size, units)
+views = nn.ModuleDict(separate_heads(feat_size, units))
+views.load_state_dict(heads.state_dict())
+fused = networks.fuse_scalar_heads(views, list(heads.keys()))
+
+feat = torch.randn(16, 50, feat_size)
+with torch.no_grad():
+  for name, a, b in zip(heads, run_separate(heads, feat), run_fused(fused, feat)):
+    print(f'{name:9s} max abs diff {(a - b).abs().max().item():.2e}')
+
+# reward trains the features, cost and discount only their own weights
+stop = ['cost', 'discount']
+feat = torch.randn(16, 50, feat_size, requires_grad=True)
+sum(heads[name](feat.detach() if name in stop else feat).mean.sum()
+    for name in heads).backward()
+a, feat.grad = feat.grad, None
+fused.clear()
+sum(dist.mean.sum() for dist in fused(feat, stop=stop).values()).backward()
+print(f'stopped heads feature grad max abs diff {(a - feat.grad).abs().max().item():.2e}')
+fused.clear()
+
+state = {'heads.' + k: v for k, v in heads.state_dict().items()}
+fused.fuse_state_dict(state, 'heads.', 'scalar.')
+fused.load_state_dict({k[len('scalar.'):]: v for k, v in state.items()})
+fused.split_state_dict(state, 'heads.', 'scalar.')
+restored = {k[len('heads.'):]: v for k, v in state.items()}
+assert all(torch.equal(v, restored[k]) for k, v in heads.state_dict().items())
+print('state dict round trip ok')
+
+for rows in (15 * 50, 16 * 50 * 15, 16 * 50 * 64):
+  feat = torch.randn(rows, feat_size)
+  for grad in (False, True):
+    old = timed(run_separate, heads, feat, grad=grad)
+    new = timed(run_fused, fused, feat, grad=grad)
+    mode = 'fwd+bwd' if grad else 'forward'
+    print(f'rows {rows:6d} {mode}  separate {1000 * old:8.2f} ms  '
+          f'fused {1000 * new:8.2f} ms  speedup {old / new:.2f}x')
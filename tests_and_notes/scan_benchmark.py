@@ -0,0 +1,48 @@
+import pathlib
+import sys
+import time
+
+import torch
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+import ma_networks as networks
+import ma_tools as tools
+
+# Times RSSM.imagine with the torch.cat scan it used before and with the
+# current tools.static_scan, on CPU for several horizons.
+
+
+def cat_scan(fn, inputs, start):
+  last = start
+  outputs = None
+  for index in range(inputs[0].shape[0]):
+    last = fn(last, *(_input[index] for _input in inputs))
+    if outputs is None:
+      outputs = {key: value.clone().unsqueeze(0) for key, value in last.items()}
+    else:
+      for key in last.keys():
+        outputs[key] = torch.cat([outputs[key], last[key].unsqueeze(0)], dim=0)
+  return [outputs]
+
+
+def timed(scan, rssm, action, state, repeats):
+  with torch.no_grad():
+    scan(rssm.img_step, [action], state)
+    start = time.perf_counter()
+    for _ in range(repeats):
+      scan(rssm.img_step, [action], state)
+  return (time.perf_counter() - start) / repeats
+
+
+torch.manual_seed(0)
+batch, num_actions = 256, 2
+rssm = networks.RSSM(
+    stoch=50, deter=200, hidden=200, cell='gru_layer_norm',
+    num_actions=num_actions, embed=1024, device='cpu')
+state = rssm.initial(batch)
+for horizon in (15, 50, 100, 200):
+  action = torch.rand(horizon, batch, num_actions) * 2 - 1
+  old = timed(cat_scan, rssm, action, state, 5)
+  new = timed(tools.static_scan, rssm, action, state, 5)
+  print(f'horizon {horizon:4d}  torch.cat {1000 * old:8.2f} ms  '
+        f'stack once {1000 * new:8.2f} ms  speedup {old / new:.2f}x')
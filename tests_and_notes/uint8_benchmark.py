@@ -0,0 +1,57 @@
+import pathlib
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+import ma_networks as networks
+
+# Host to device copy and encoder step time of a [16, 50] image batch, with
+# the frames normalised to float32 on the host before the copy and with the
+# uint8 frames copied and normalised by the encoder on the device.
+
+
+def synchronize(device):
+  if device.type == 'cuda':
+    torch.cuda.synchronize()
+
+
+def timed(fn, device, repeats=20):
+  fn()
+  synchronize(device)
+  start = time.perf_counter()
+  for _ in range(repeats):
+    fn()
+  synchronize(device)
+  return (time.perf_counter() - start) / repeats
+
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+pin = device.type == 'cuda'
+frames = np.random.RandomState(0).randint(
+    0, 256, (16, 50, 64, 64, 3), dtype=np.uint8)
+encoder = networks.ConvEncoder(depth=32, act=torch.nn.ELU).to(device)
+
+host_float = torch.tensor(frames, dtype=torch.float32) / 255.0 - 0.5
+host_uint8 = torch.tensor(frames)
+if pin:
+  host_float, host_uint8 = host_float.pin_memory(), host_uint8.pin_memory()
+
+for name, host in (('float32', host_float), ('uint8', host_uint8)):
+  size = host.element_size() * host.nelement()
+  copy = timed(lambda: host.to(device, non_blocking=pin), device)
+
+  def step():
+    with torch.no_grad():
+      encoder({'image': host.to(device, non_blocking=pin)})
+
+  total = timed(step, device)
+  print(f'{name:8s} {size / 2 ** 20:7.1f} MB  copy {1000 * copy:7.2f} ms '
+        f'({size / copy / 2 ** 30:6.2f} GB/s)  copy+encoder {1000 * total:7.2f} ms')
+
+with torch.no_grad():
+  a = encoder({'image': host_float.to(device)})
+  b = encoder({'image': host_uint8.to(device)})
+print(f'max abs diff of the embeddings {(a - b).abs().max().item():.2e}')